@@ -18,6 +18,7 @@ from . import calib
 from . import config
 from . import data
 from . import fit
+from . import libcache
 from . import model
 from . import plots
 from . import specz
@@ -51,15 +51,24 @@ def get_bands(field):
 
 def get_input(output_dir, model_dir, memba_prod, field, fit_bands,
               only_specz, coadd_file):
-    """Get the input to run the photo-z code."""
+    """Get the input to run the photo-z code. The catalogue is stored
+       with a fingerprint of the models and selection in the file name,
+       which is also returned.
+    """
    
 
-    path_galcat = output_dir / 'galcat_in.pq'
-
     # The model.
     runs = bcnz.config.eriksen2019()
     modelD = bcnz.model.cache_model(model_dir, runs)
 
+    # The database content is not fingerprinted, since it would require
+    # running the queries.
+    key = bcnz.libcache.fingerprint(
+        modelD, memba_prod=memba_prod, field=field, fit_bands=fit_bands,
+        only_specz=only_specz,
+        coadd_file=None if coadd_file is None else Path(coadd_file))
+    path_galcat = bcnz.libcache.keyed_path(output_dir / 'galcat_in.pq', key)
+
     if not output_dir.exists():
         output_dir.mkdir()
 
@@ -68,7 +77,7 @@ def get_input(output_dir, model_dir, memba_prod, field, fit_bands,
         # Not actually being used...
         galcat_inp = pd.read_parquet(str(path_galcat))
 
-        return runs, modelD, galcat_inp
+        return runs, modelD, galcat_inp, path_galcat
 
     # And then estimate the catalogue.
     engine = bcnz.connect_db()
@@ -90,9 +99,11 @@ def get_input(output_dir, model_dir, memba_prod, field, fit_bands,
     # Temporary hack.... 
     galcat_inp = bcnz.fit.flatten_input(galcat_inp) 
     
-    galcat_inp.to_parquet(str(path_galcat))
+    path_tmp = path_galcat.with_name(path_galcat.name + '.tmp')
+    galcat_inp.to_parquet(str(path_tmp))
+    path_tmp.replace(path_galcat)
 
-    return runs, modelD, galcat_inp
+    return runs, modelD, galcat_inp, path_galcat
 
 
 def fix_model(modelD, fit_bands):
@@ -104,7 +115,19 @@ def fix_model(modelD, fit_bands):
     return new_modelD
 
 
-def run_photoz_dask(runs, modelD, galcat, output_dir, fit_bands, ip_dask):
+def scatter_dict(client, D):
+    """Scatter the values of a dictionary. Scattering the dictionary
+       itself uses its keys as Dask keys, which collide between calls.
+    """
+
+    keys = list(D.keys())
+
+    return dict(zip(keys, client.scatter([D[x] for x in keys])))
+
+
+def run_photoz_dask(runs, modelD, galcat, output_dir, fit_bands, ip_dask,
+                    npartitions=None, mem_limit=None, n_threads=None,
+                    save_cube=False, pz_format='columns', path_galcat=None):
 
     """Run the photo-z on a Dask cluster."""
 
@@ -115,17 +138,34 @@ def run_photoz_dask(runs, modelD, galcat, output_dir, fit_bands, ip_dask):
 
     # If not specified, we start up a local cluster.
     client = Client(ip_dask) if not ip_dask is None else Client()
-    xnew_modelD = client.scatter(fix_model(modelD, fit_bands))
+    new_modelD = fix_model(modelD, fit_bands)
+    xnew_modelD = scatter_dict(client, new_modelD)
     #xnew_modelD = fix_model(modelD, fit_bands)
 
-    galcat = dd.read_parquet(str(output_dir / 'galcat_in.pq'))
+    # The normalized models are only computed once for all partitions.
+    xmodel_cache = scatter_dict(client, bcnz.fit.prepare_models(new_modelD, fit_bands))
+
+    if path_galcat is None:
+        path_galcat = Path(output_dir) / 'galcat_in.pq'
+
+    galcat = dd.read_parquet(str(path_galcat))
 
     #npartitions = int(302138 / 10) + 1
-    npartitions = int(9900 / 10) + 1
+    if npartitions is None:
+        npartitions = int(9900 / 10) + 1
+
     galcat = galcat.reset_index().repartition(npartitions=npartitions).set_index('ref_id')
 
     ebvD = dict(runs.EBV)
 
+    # The chi2 and norm for estimating the catalogue again.
+    cube_dir = None
+    if save_cube:
+        cube_dir = Path(output_dir) / 'cube'
+        cube_dir.mkdir(exist_ok=True)
+        bcnz.fit.libcube.check_cube_dir(cube_dir)
+        cube_dir = str(cube_dir)
+
 
     # To disabled if you want to run a test on a few galaxies without Dask.
 #    sub = galcat.head(4)
@@ -134,7 +174,9 @@ def run_photoz_dask(runs, modelD, galcat, output_dir, fit_bands, ip_dask):
 #    dask.config.set(scheduler='threads')
 
     pzcat = galcat.map_partitions(
-        bcnz.fit.photoz_flatten, xnew_modelD, ebvD, fit_bands)
+        bcnz.fit.photoz_flatten, xnew_modelD, ebvD, fit_bands,
+        mem_limit=mem_limit, model_cache=xmodel_cache, n_threads=n_threads,
+        cube_dir=cube_dir, pz_format=pz_format)
 
 #    print('Finished...')
 
@@ -190,7 +232,8 @@ def validate(output_dir, field):
 
 
 def run_photoz(output_dir, model_dir, memba_prod, field, fit_bands=None, only_specz=False, 
-               ip_dask=None, coadd_file=None):
+               ip_dask=None, coadd_file=None, npartitions=None, mem_limit=None,
+               n_threads=None, save_cube=False, pz_format='columns'):
     """Run the photo-z over a catalogue in the PAUdm database.
 
        Args:
@@ -202,16 +245,26 @@ def run_photoz(output_dir, model_dir, memba_prod, field, fit_bands=None, only_sp
            only_specz (bool): Only run photo-z for galaxies with spec-z.
            ip_dask (str): IP for Dask scheduler.
            coadd_file (str): Path to file containing the coadds.
+           npartitions (int): Number of Dask partitions for the galaxies.
+           mem_limit (float): Memory budget (MB) for the minimization in each partition.
+           n_threads (int): Threads for fitting the runs within each partition.
+           save_cube (bool): Store the chi2 and norm of all runs in the
+                             cube directory.
+           pz_format (str): Store the p(z) as one column per redshift
+                            ('columns') or in a compact binary column
+                            ('binary'), read with bcnz.fit.decode_pz.
     """
 
    
     output_dir = Path(output_dir)
 
     fit_bands = get_bands(field)
-    runs, modelD, galcat = get_input(
+    runs, modelD, galcat, path_galcat = get_input(
         output_dir, model_dir, memba_prod, field, fit_bands, only_specz, coadd_file)
 
-    run_photoz_dask(runs, modelD, galcat, output_dir, fit_bands, ip_dask)
+    run_photoz_dask(runs, modelD, galcat, output_dir, fit_bands, ip_dask,
+                    npartitions=npartitions, mem_limit=mem_limit, n_threads=n_threads,
+                    save_cube=save_cube, pz_format=pz_format, path_galcat=path_galcat)
 
     validate(output_dir, field)
 
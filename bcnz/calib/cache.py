@@ -19,24 +19,34 @@
 from pathlib import Path
 import pandas as pd
 
+from ..libcache import cached, fingerprint, keyed_path
+from .calib import calib
+
 
 def cache_zp(output_dir, *args, **kwds):
-    """Functionality for caching the zero-points.
+    """Functionality for caching the zero-points. The file name includes a
+       fingerprint of the input catalogue, models and parameters.
+
        Args:
            run_dir: Directory to store the results.
+
+       Only the zero-points are stored, so return_details and n_boot are
+       not supported.
     """
 
-    output_dir = Path(output_dir)
-    path = output_dir / 'zp.h5'
+    for name in ('return_details', 'n_boot'):
+        if kwds.get(name):
+            raise ValueError(f'Caching the zero-points does not support {name}.')
 
+    # Only options changing the result are part of the key.
+    conf = {k: v for k, v in kwds.items() if k not in ('n_procs', 'client')}
+    key = fingerprint(*args, **conf)
+    path = keyed_path(Path(output_dir) / 'zp.h5', key)
 
     print('Calibrating the fluxes')
 
-    import bcnz
-    if not path.exists():
-        zp = bcnz.calib.calib(*args, **kwds)
-        zp.to_hdf(path, 'default')
-    else:
-        zp = pd.read_hdf(path, 'default')
+    zp = cached(path, lambda: calib(*args, **kwds),
+                lambda x: pd.read_hdf(x, 'default'),
+                lambda zp, x: zp.to_hdf(x, 'default'))
 
     return zp
@@ -19,6 +19,7 @@
 from IPython.core import debugger as ipdb
 import sys
 import time
+import warnings
 import numpy as np
 import pandas as pd
 import xarray as xr
@@ -26,6 +27,7 @@ from tqdm import tqdm
 from scipy.optimize import minimize
 
 from . import libcalib
+from .libparallel import part_pool, map_shared
 
 
 def _prepare_input(modelD, galcat, SNR_min, cosmos_scale, fit_bands):
@@ -91,8 +93,49 @@ def _zp_min_cost(cost, best_flux, flux, err_inv):
     return zp
 
 
-def _calc_zp(best_flux, flux, flux_error):
-    """Estimate the zero-point."""
+def _zp_bisect(best_flux, flux, err_inv, zp_min=0.5, zp_max=2., tol=1e-10):
+    """Estimate the zero-points of all bands together.
+
+       The zero-point is where the median of the normalized residuals
+       crosses zero, which is found by bisection in all bands at once.
+       Bands where the median does not change sign between the limits,
+       e.g. without any measurements or when negative fluxes make the
+       median non-monotonic, are returned as NaN.
+    """
+
+    # Arrays with shape (galaxy, band).
+    dims = ('ref_id', 'band')
+    slope = (err_inv*flux).transpose(*dims).values
+    offset = (err_inv*best_flux).transpose(*dims).values
+
+    def median_res(R):
+        # Bands without measurements give NaN.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmedian(slope*R - offset, axis=0)
+
+    lo = np.full(slope.shape[1], zp_min)
+    hi = np.full(slope.shape[1], zp_max)
+    sign_lo = np.sign(median_res(lo))
+    bracketed = sign_lo*np.sign(median_res(hi)) <= 0
+
+    while np.max(hi - lo) > tol:
+        mid = 0.5*(lo + hi)
+        same = np.sign(median_res(mid)) == sign_lo
+        lo = np.where(same, mid, lo)
+        hi = np.where(same, hi, mid)
+
+    return np.where(bracketed, 0.5*(lo + hi), np.nan)
+
+def _calc_zp(best_flux, flux, flux_error, zp_method='minimize', counts=None):
+    """Estimate the zero-point. The galaxies are repeated according to
+       counts, when given.
+    """
+
+    if counts is not None:
+        ind = np.repeat(np.arange(len(flux.ref_id)), counts)
+        best_flux, flux, flux_error = [x.isel(ref_id=ind) for x in
+                                       (best_flux, flux, flux_error)]
 
     err_inv = 1. / flux_error
     X = (best_flux, flux, err_inv)
@@ -100,7 +143,18 @@ def _calc_zp(best_flux, flux, flux_error):
     def cost_flux(R, model, flux, err_inv):
         return float(np.abs((err_inv*(flux*R[0] - model)).median()))
 
-    zp = _zp_min_cost(cost_flux, *X)
+    if zp_method == 'minimize':
+        zp = _zp_min_cost(cost_flux, *X)
+    elif zp_method == 'bisect':
+        zp = _zp_bisect(*X)
+
+        # The bands without a crossing are minimized separately.
+        missing = np.nonzero(np.isnan(zp))[0]
+        if len(missing):
+            zp[missing] = _zp_min_cost(cost_flux, *[x.isel(band=missing) for x in X])
+    else:
+        raise ValueError(f'Unknown zp_method: {zp_method}')
+
     zp = xr.DataArray(zp, dims=('band',), coords={'band': flux.band})
 
     return zp
@@ -115,18 +169,25 @@ def _which_filters(fit_bands):
     return NBlist, BBlist
 
 
-def _find_best_model(modelD, flux_model, flux, flux_error, chi2, fit_bands,
-                     Niter, Nskip):
-    """Find the best flux model."""
+def _find_best_model(fit_parts, flux_model, flux, flux_error, chi2, fit_bands,
+                     Niter, Nskip, tol, startD=None):
+    """Find the best flux model. The parts are fitted with fit_parts from
+       part_pool. When given a dictionary startD, the minimization starts
+       from and updates the amplitudes of each part.
+    """
 
     # Just get a normal list of the models.
     model_parts = [int(x.values) for x in flux_model.part]
 
     NBlist, BBlist = _which_filters(fit_bands)
-    for j, key in enumerate(model_parts):
-        K = (modelD[key], flux, flux_error, NBlist, BBlist, Niter, Nskip)
-        chi2_part, F = libcalib.minimize_at_z(*K)
-        chi2[j, :] = chi2_part.sum(dim='band')
+    fit_args = (NBlist, BBlist, Niter, Nskip, tol)
+    resL = fit_parts(model_parts, flux, flux_error, fit_args, startD)
+
+    for j, (key, (chi2_part, F, v, k)) in enumerate(zip(model_parts, resL)):
+        if startD is not None:
+            startD[key] = (v, k)
+
+        chi2[j, :] = chi2_part
 
         # Weird ref_id, gal index issue..
         assert (flux_model.ref_id.values == F.ref_id.values).all()
@@ -148,8 +209,9 @@ def _find_best_model(modelD, flux_model, flux, flux_error, chi2, fit_bands,
     return best_flux
 
 
-def _zero_points(modelD, galcat, fit_bands, SNR_min, cosmos_scale, Nrounds, Niter, learn_rate, Nskip):
-    """Estimate the zero-points."""
+def _zero_points(modelD, galcat, fit_bands, SNR_min, cosmos_scale, Nrounds, Niter, learn_rate, Nskip,
+                 tol, zp_method, warm_start, zp_tol, n_procs, client, counts=None):
+    """Estimate the zero-points, weighting the galaxies with counts."""
 
     # Just simple input transformations.
     flux, flux_error, chi2, zp_tot, flux_model = _prepare_input(modelD, galcat,
@@ -157,23 +219,37 @@ def _zero_points(modelD, galcat, fit_bands, SNR_min, cosmos_scale, Nrounds, Nite
 
     flux_orig = flux.copy()
 
+    startD = {} if warm_start else None
+
+    t1 = time.time()
     zp_details = {}
-    for i in tqdm(range(Nrounds)):
-        best_flux = _find_best_model(
-            modelD, flux_model, flux, flux_error, chi2, fit_bands, Niter, Nskip)
+    with part_pool(modelD, flux, n_procs, client) as fit_parts:
+        for i in tqdm(range(Nrounds)):
+            best_flux = _find_best_model(
+                fit_parts, flux_model, flux, flux_error, chi2, fit_bands, Niter, Nskip,
+                tol, startD)
+
+            zp = _calc_zp(best_flux, flux, flux_error, zp_method, counts)
+            zp = 1 + learn_rate*(zp - 1.)
 
-        zp = _calc_zp(best_flux, flux, flux_error)
-        zp = 1 + learn_rate*(zp - 1.)
+            flux = flux*zp
+            flux_error = flux_error*zp
 
-        flux = flux*zp
-        flux_error = flux_error*zp
+            zp_tot *= zp
+            zp_details[i] = zp_tot.copy()
 
-        zp_tot *= zp
-        zp_details[i] = zp_tot.copy()
+            # Stop when the zero-points no longer change.
+            if zp_tol is not None and 0 < i and \
+               float(np.abs(zp_details[i] / zp_details[i-1] - 1).max()) < zp_tol:
+                break
 
-        # We mostly need this for debug and the paper.
-        if i == Nrounds - 1:
-            ratio_all = best_flux / flux_orig
+    # We mostly need this for debug and the paper.
+    ratio_all = best_flux / flux_orig
+
+    nrounds = len(zp_details)
+    t_round = (time.time() - t1) / nrounds
+    print('Calibration rounds: {} of {}, {:.1f}s per round, saved about {:.1f}s'.format(
+          nrounds, Nrounds, t_round, t_round*(Nrounds - nrounds)))
 
     zp_tot = zp_tot.to_series()
     zp_details = pd.DataFrame(zp_details, index=flux.band)
@@ -181,6 +257,23 @@ def _zero_points(modelD, galcat, fit_bands, SNR_min, cosmos_scale, Nrounds, Nite
     return zp_tot, zp_details, ratio_all
 
 
+def _zp_replicate(shared, ind):
+    """Zero-points for a bootstrap sample of the galaxies."""
+
+    f_modD, galcat, config = shared
+
+    # Repeated galaxies give the same fit, so they are only fitted once
+    # and instead weighted when estimating the zero-points. Each sample
+    # starts from the same zero-points as the fit of all galaxies, since
+    # starting from that result would bias the samples towards it.
+    uind, counts = np.unique(ind, return_counts=True)
+    f_modD = {k: v.isel(z=uind) for k, v in f_modD.items()}
+
+    zp, _, _ = _zero_points(f_modD, galcat.iloc[uind], counts=counts, **config)
+
+    return zp
+
+
 def sel_subset(galcat, fit_bands):
     """Select which subset to use for finding the zero-points."""
 
@@ -198,7 +291,9 @@ def sel_subset(galcat, fit_bands):
 
 
 def calib(galcat, modelD, fit_bands, SNR_min=-5, Nrounds=20, Niter=1001, cosmos_scale=False,
-          learn_rate=1.0, Nskip=10, return_details=False):
+          learn_rate=1.0, Nskip=10, return_details=False, tol=None,
+          zp_method='minimize', warm_start=False, zp_tol=None, n_procs=None,
+          client=None, n_boot=0, boot_seed=None):
     """Calibrate zero-points by comparing the result at the spectroscopic redshift.
 
        Args:
@@ -209,11 +304,40 @@ def calib(galcat, modelD, fit_bands, SNR_min=-5, Nrounds=20, Niter=1001, cosmos_
            Niter(int): Number of minimization steps.
            learn_rate (float): How fast to update the zero-points.
            Nskip(int): Skipping updating the nb versus bb each iteration.
+           tol(float): Tolerance for stopping the minimization of a galaxy.
+           zp_method (str): How to find the zero-points from the median
+                            cost. Either 'minimize' for a separate
+                            minimization of each band or 'bisect' for a
+                            bisection in all bands at once.
+           warm_start (bool): Start the minimization in each round from
+                              the amplitudes of the previous round. Reduces
+                              the iterations when setting tol.
+           zp_tol (float): Stop when the relative change in all zero-points
+                           within a round is below this value.
+           n_procs (int): Number of processes for fitting the model parts
+                          in parallel. The fluxes are shared in memory.
+           client (Client): Dask client for fitting the model parts.
+           n_boot (int): Number of bootstrap samples of the calibration
+                         galaxies for estimating the zero-point
+                         uncertainties. The samples are calibrated
+                         like all the galaxies, from the same starting
+                         point, and run in parallel when setting n_procs
+                         or client. The processes are spawned, so a
+                         script setting n_procs needs to call calib
+                         within an "if __name__ == '__main__':" block.
+           boot_seed (int): Seed for drawing the bootstrap samples.
+
+       Returns:
+           The zero-points, with zp_details and ratio_all when setting
+           return_details. When bootstrapping, the zero-points of each
+           sample, with dimensions (band, sample), are returned last.
     """
 
     config = {'fit_bands': fit_bands, 'SNR_min': SNR_min, 'Nrounds': Nrounds,
               'cosmos_scale': cosmos_scale, 'Niter': Niter,
-              'learn_rate': learn_rate, 'Nskip': Nskip}
+              'learn_rate': learn_rate, 'Nskip': Nskip, 'tol': tol,
+              'zp_method': zp_method, 'warm_start': warm_start,
+              'zp_tol': zp_tol, 'n_procs': n_procs, 'client': client}
 
     # Loads model exactly at the spectroscopic redshift for each galaxy.
     galcat = sel_subset(galcat, fit_bands)
@@ -222,7 +346,18 @@ def calib(galcat, modelD, fit_bands, SNR_min=-5, Nrounds=20, Niter=1001, cosmos_
     zp, zp_details, ratio_all = _zero_points(f_modD, galcat, **config)
     ratio_all = ratio_all.to_dataframe('ratio')
 
-    if not return_details:
-        return zp
-    else:
-        return zp, zp_details, ratio_all
+    out = (zp, zp_details, ratio_all) if return_details else (zp,)
+    if n_boot:
+        # The parallelization is over the samples.
+        boot_config = dict(config, n_procs=None, client=None)
+        shared = (f_modD, galcat, boot_config)
+
+        rng = np.random.default_rng(boot_seed)
+        argsL = [(rng.integers(len(galcat), size=len(galcat)),) for i in range(n_boot)]
+
+        zpL = map_shared(_zp_replicate, shared, argsL, n_procs, client)
+        zp_boot = pd.concat(zpL, axis=1, keys=range(n_boot), names=['sample'])
+
+        out = out + (zp_boot,)
+
+    return out[0] if len(out) == 1 else out
@@ -23,6 +23,8 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 
+from ..fit import core
+
 import numpy as np
 np.seterr(divide='ignore', invalid='ignore')
 
@@ -59,7 +61,8 @@ def model_at_z(zs, modelD, fit_bands):
     return f_modD
 
 
-def minimize_at_z(f_mod, flux, flux_err, NBlist, BBlist, Niter, Nskip):
+def minimize_at_z(f_mod, flux, flux_err, NBlist, BBlist, Niter, Nskip, tol=None,
+                  v0=None, k0=None, return_norm=False):
     """Minimize at a known redshift.
 
        Args: 
@@ -70,6 +73,12 @@ def minimize_at_z(f_mod, flux, flux_err, NBlist, BBlist, Niter, Nskip):
            BBlist (list): List with broad bands to fit.
            Niter (int): How many iterations to run.
            Nskip (int): Number of iterations between each BB vs NB adjustment.
+           tol (float): Stop iterating galaxies where the relative change in the
+                        amplitudes between the adjustments is below tol.
+           v0 (array): Start amplitudes with shape (galaxy, sed).
+           k0 (array): Start NB versus BB scaling for each galaxy.
+           return_norm (bool): Also return the amplitudes and scaling, e.g.
+                               for starting the next calibration round.
     """
 
     var_inv = 1. / flux_err**2
@@ -79,72 +88,28 @@ def minimize_at_z(f_mod, flux, flux_err, NBlist, BBlist, Niter, Nskip):
     var_inv.values[mask] = 0.
     flux = flux.fillna(0.)
 
-    A_NB = np.einsum('gf,gfs,gft->gst', var_inv.sel(band=NBlist),
-                     f_mod.sel(band=NBlist), f_mod.sel(band=NBlist))
-    b_NB = np.einsum('gf,gf,gfs->gs', var_inv.sel(band=NBlist), flux.sel(band=NBlist),
-                     f_mod.sel(band=NBlist))
-    A_BB = np.einsum('gf,gfs,gft->gst', var_inv.sel(band=BBlist),
-                     f_mod.sel(band=BBlist), f_mod.sel(band=BBlist))
-    b_BB = np.einsum('gf,gf,gfs->gs', var_inv.sel(band=BBlist), flux.sel(band=BBlist),
-                     f_mod.sel(band=BBlist))
-
-    # Testing to scale to the narrow bands. In that case the code above is not needed.
-    scale_to = NBlist
-    var_inv_NB = var_inv.sel(band=scale_to)
-    flux_NB = flux.sel(band=scale_to)
-    f_mod_NB = f_mod.sel(band=scale_to)
-    S1 = (var_inv_NB*flux_NB).sum(dim='band')
-
-    # Since we need these entries in the beginning...
-    k = np.ones(len(flux))
-    b = b_BB + k[:, np.newaxis]*b_NB
-    A = A_BB + k[:, np.newaxis, np.newaxis]**2*A_NB
-
-    v = 100*np.ones_like(b)
-
-    ref_id = flux.ref_id.values
-    coords = {'ref_id': ref_id, 'band': f_mod.band}
-    coords_norm = {'ref_id': ref_id, 'model': f_mod.sed}
-
-    t1 = time.time()
-    for i in range(Niter):
-        a = np.einsum('gst,gt->gs', A, v)
-
-        m0 = b / a
-        m0 = np.nan_to_num(m0)
-
-        vn = m0*v
+    # The model is already normalized when loading it.
+    bands = NBlist + BBlist
+    nb_mask = np.array([x in NBlist for x in bands])
+    f_mod = f_mod.sel(band=bands)
 
-        v = vn
-        # Extra step for the amplitude
-        if 0 < i and i % Nskip == 0:
-            # Testing a new form for scaling the amplitude...
-            flux_mod = np.einsum('gfs,gs->gf', f_mod_NB, v)
-            S1 = np.einsum('gf,gf,gf->g', var_inv_NB, flux_NB, flux_mod)
-            S2 = np.einsum('gf,gf->g', var_inv_NB, flux_mod**2)
-
-            k = S1 / S2
-
-            # Just to avoid crazy values ...
-            k = np.clip(k, 0.1, 10)
-
-            b = b_BB + k[:, None]*b_NB
-            A = A_BB + k[:, None, None]**2*A_NB
-
-    # I was comparing with the standard algorithm above...
-    v_scaled = v
-    k_scaled = k
+    chi2, v, k, n_iter = core.fit_at_z(
+        flux.sel(band=bands).values, var_inv.sel(band=bands).values,
+        f_mod.values, nb_mask, Niter=Niter, Nskip=Nskip, tol=tol,
+        k_method='lsq', v0=v0, k0=k0)
 
     L = []
-    L.append(np.einsum('g,gfs,gs->gf', k_scaled,
-                       f_mod.sel(band=NBlist), v_scaled))
-    L.append(np.einsum('gfs,gs->gf', f_mod.sel(band=BBlist), v_scaled))
+    L.append(np.einsum('g,gfs,gs->gf', k, f_mod.values[:, nb_mask], v))
+    L.append(np.einsum('gfs,gs->gf', f_mod.values[:, ~nb_mask], v))
 
     Fx = np.hstack(L)
 
-    coords['band'] = NBlist + BBlist
+    coords = {'ref_id': flux.ref_id.values, 'band': bands}
     Fx = xr.DataArray(Fx, coords=coords, dims=('ref_id', 'band'))
 
     chi2x = var_inv*(flux - Fx)**2
 
+    if return_norm:
+        return chi2x, Fx, v, k
+
     return chi2x, Fx
@@ -0,0 +1,206 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Fitting the model parts in parallel when calibrating. The parts are
+# independent given the fluxes, which change between the rounds. With a
+# process pool, the models are sent once to each worker and the fluxes are
+# shared in memory. With a Dask client, the models are scattered once and
+# the fluxes in each round. Independent calibrations, like the bootstrap
+# replicates, are run in parallel with map_shared.
+#
+# The worker processes are spawned and import the main module again. Scripts
+# using n_procs therefore need to guard the calibration with
+#
+#   if __name__ == '__main__':
+#       zp = bcnz.calib.calib(galcat, modelD, fit_bands, n_procs=4)
+#
+# or each worker would start the whole script again.
+
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import xarray as xr
+
+from . import libcalib
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# Models and shared fluxes in each worker process.
+_worker = {}
+
+# Forking after the BLAS or Numba threads have started can deadlock.
+_mp_context = multiprocessing.get_context('spawn')
+
+def _single_thread():
+    """Each process should only use a single thread."""
+
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+
+    from ..fit import libmult
+    if libmult.HAS_NUMBA:
+        import numba
+        numba.set_num_threads(1)
+
+def _init_worker(modelD, names, shape):
+    """Store the models and attach to the shared fluxes."""
+
+    _single_thread()
+
+    _worker['modelD'] = modelD
+    _worker['shm'] = [shared_memory.SharedMemory(name=x) for x in names]
+    _worker['shape'] = shape
+
+def _fit_part(f_mod, flux, flux_error, coords, fit_args, v0, k0):
+    """Minimize a single model part with fluxes of shape (galaxy, band)."""
+
+    dims = ('ref_id', 'band')
+    flux = xr.DataArray(flux, coords=coords, dims=dims)
+    flux_error = xr.DataArray(flux_error, coords=coords, dims=dims)
+
+    chi2_part, F, v, k = libcalib.minimize_at_z(
+        f_mod, flux, flux_error, *fit_args, v0=v0, k0=k0, return_norm=True)
+
+    return chi2_part.sum(dim='band'), F, v, k
+
+def _fit_part_shared(key, coords, fit_args, v0, k0):
+    """Minimize a model part using the fluxes in shared memory."""
+
+    shape = _worker['shape']
+    flux, flux_error = [np.ndarray(shape, buffer=x.buf) for x in _worker['shm']]
+
+    return _fit_part(_worker['modelD'][key], flux, flux_error, coords, fit_args,
+                     v0, k0)
+
+def _start(startD, key):
+    return (None, None) if startD is None else startD.get(key, (None, None))
+
+def _values(X):
+    return np.ascontiguousarray(X.transpose('ref_id', 'band').values)
+
+@contextmanager
+def part_pool(modelD, flux, n_procs=None, client=None):
+    """Function for fitting the model parts, possibly in parallel.
+
+       Args:
+           modelD (dict): Models at the spectroscopic redshifts.
+           flux (DataArray): Fluxes, only used for the shapes.
+           n_procs (int): Number of processes.
+           client (Client): Dask client to use instead of a process pool.
+
+       Yields:
+           Function taking (keys, flux, flux_error, fit_args, startD) and
+           returning a list with (chi2, F, v, k) for each part.
+    """
+
+    if client is not None:
+        # Scattering a dict would use the integer part keys as Dask keys.
+        keysL = list(modelD.keys())
+        xmodelD = dict(zip(keysL, client.scatter([modelD[x] for x in keysL],
+                                                 broadcast=True)))
+
+        def fit_parts(keys, flux, flux_error, fit_args, startD):
+            coords = {'ref_id': flux.ref_id.values, 'band': flux.band.values}
+            xflux, xflux_error = client.scatter(
+                [_values(flux), _values(flux_error)], broadcast=True)
+
+            futures = [client.submit(_fit_part, xmodelD[key], xflux, xflux_error,
+                                     coords, fit_args, *_start(startD, key),
+                                     pure=False) for key in keys]
+
+            return client.gather(futures)
+
+        yield fit_parts
+
+    elif n_procs is None or n_procs <= 1:
+        def fit_parts(keys, flux, flux_error, fit_args, startD):
+            coords = {'ref_id': flux.ref_id.values, 'band': flux.band.values}
+            return [_fit_part(modelD[key], _values(flux), _values(flux_error),
+                              coords, fit_args, *_start(startD, key))
+                    for key in keys]
+
+        yield fit_parts
+
+    else:
+        shape = (len(flux.ref_id), len(flux.band))
+        nbytes = int(np.prod(shape))*np.dtype(np.float64).itemsize
+        shmL = [shared_memory.SharedMemory(create=True, size=nbytes) for i in range(2)]
+        arrays = [np.ndarray(shape, buffer=x.buf) for x in shmL]
+
+        def fit_parts(keys, flux, flux_error, fit_args, startD):
+            arrays[0][:] = _values(flux)
+            arrays[1][:] = _values(flux_error)
+
+            coords = {'ref_id': flux.ref_id.values, 'band': flux.band.values}
+            futures = [pool.submit(_fit_part_shared, key, coords, fit_args,
+                                   *_start(startD, key)) for key in keys]
+
+            return [x.result() for x in futures]
+
+        try:
+            initargs = (modelD, [x.name for x in shmL], shape)
+            with ProcessPoolExecutor(n_procs, mp_context=_mp_context,
+                                     initializer=_init_worker,
+                                     initargs=initargs) as pool:
+                yield fit_parts
+        finally:
+            del arrays
+            for x in shmL:
+                x.close()
+                x.unlink()
+
+def _init_shared(shared):
+    _single_thread()
+    _worker['shared'] = shared
+
+def _call_shared(func, args):
+    return func(_worker['shared'], *args)
+
+def map_shared(func, shared, argsL, n_procs=None, client=None):
+    """Call func(shared, *args) for each entry in argsL, possibly in parallel.
+
+       Args:
+           func (function): Module level function to call.
+           shared (object): Input sent once to each worker.
+           argsL (list): Arguments for each call.
+           n_procs (int): Number of processes.
+           client (Client): Dask client to use instead of a process pool.
+    """
+
+    if client is not None:
+        # Wrapped, since scattering a list or dict scatters the entries.
+        xshared = client.scatter([shared], broadcast=True)[0]
+        futures = [client.submit(func, xshared, *args, pure=False) for args in argsL]
+
+        return client.gather(futures)
+
+    elif n_procs is None or n_procs <= 1:
+        return [func(shared, *args) for args in argsL]
+
+    else:
+        with ProcessPoolExecutor(n_procs, mp_context=_mp_context,
+                                 initializer=_init_shared,
+                                 initargs=(shared,)) as pool:
+            futures = [pool.submit(_call_shared, func, args) for args in argsL]
+
+            return [x.result() for x in futures]
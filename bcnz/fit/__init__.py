@@ -13,5 +13,9 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
-from .photoz import photoz, photoz_flatten, flatten_input
+from .photoz import photoz, photoz_flatten, flatten_input, prepare_models
 
+from .compare import compare_engines, compare_dtypes, compare_screening
+from .core import fit_arrays, fit_at_z, fit_runs, prepare_model
+from .libcube import open_cube, pzcat_from_cube
+from .libpzcode import encode_pz, decode_pz
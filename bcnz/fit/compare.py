@@ -0,0 +1,184 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Comparing the different minimization engines, precisions and shortcuts
+# on the same input.
+
+import time
+import numpy as np
+import pandas as pd
+
+from . import libpzqual
+from .photoz import minimize_all_z
+
+def _run(galcat, modelD, fit_bands, odds_lim, width_frac, **config):
+    """Run the minimization and estimate the photo-z catalogue."""
+
+    t1 = time.time()
+    chi2, norm, n_iter, _ = minimize_all_z(galcat, modelD, fit_bands=fit_bands,
+                                           **config)
+    t2 = time.time()
+
+    pzcat, _ = libpzqual.get_pzcat(chi2, odds_lim, width_frac)
+
+    return chi2, pzcat, t2 - t1
+
+def _compare(galcat, modelD, fit_bands, configD, stats, index_name, odds_lim,
+             width_frac, **config):
+    """Run each configuration and summarize the differences to the first.
+
+       Args:
+           galcat (df): Galaxy catalogue.
+           modelD (dict): Dictionary containing all the flux models.
+           fit_bands (list): List of bands to fit.
+           configD (dict): Options for each configuration, keyed by the
+                           name in the output. The first is the reference.
+           stats (function): Called with the (chi2, pzcat) of a configuration
+                             and the reference, returning a dict of statistics.
+           index_name (str): Name of the output index.
+           odds_lim (float): Limit for estimating the ODDS.
+           width_frac (float): Limit when estimating the pz_width.
+           config (dict): Options common to all configurations.
+    """
+
+    config.setdefault('Niter', 1000)
+    config.setdefault('Nskip', 10)
+
+    D = {}
+    for name, extra in configD.items():
+        D[name] = _run(galcat, modelD, fit_bands, odds_lim, width_frac,
+                       **extra, **config)
+
+    ref = D[next(iter(D))][:2]
+
+    L = []
+    for name, (chi2, pzcat, dt) in D.items():
+        S = pd.Series(name=name, dtype=float)
+        S['time'] = dt
+        for key, val in stats((chi2, pzcat), ref).items():
+            S[key] = float(val)
+
+        L.append(S)
+
+    comp = pd.DataFrame(L)
+    comp.index.name = index_name
+
+    return comp
+
+def _engine_stats(res, ref):
+    """Differences in the chi2 to the reference engine."""
+
+    (chi2, pzcat), (chi2_ref, pzcat_ref) = res, ref
+    dchi2 = chi2 - chi2_ref
+    dchi2_min = chi2.min(dim=['run', 'z']) - chi2_ref.min(dim=['run', 'z'])
+
+    return {'dchi2_median': dchi2.median(),
+            'dchi2_max': np.abs(dchi2).max(),
+            'frac_lower': (dchi2 < 0).mean(),
+            'dchi2_min_median': dchi2_min.median(),
+            'dchi2_min_max': np.abs(dchi2_min).max(),
+            'frac_same_zb': (pzcat.zb == pzcat_ref.zb).mean()}
+
+def compare_engines(galcat, modelD, fit_bands, engines=('mult', 'nnls'),
+                    odds_lim=0.01, width_frac=0.01, **config):
+    """Compare the chi2 and wall time of the minimization engines.
+
+       Args:
+           galcat (df): Subset of galaxy catalogue to estimate photo-z.
+           modelD (dict): Dictionary containing all the flux models.
+           fit_bands (list): List of bands to fit.
+           engines (list): Engines to compare. The first is the reference.
+           odds_lim (float): Limit for estimating the ODDS.
+           width_frac (float): Limit when estimating the pz_width.
+           config (dict): Other options passed to minimize_all_z.
+    """
+
+    configD = {engine: {'engine': engine} for engine in engines}
+
+    return _compare(galcat, modelD, fit_bands, configD, _engine_stats, 'engine',
+                    odds_lim, width_frac, **config)
+
+def _dtype_stats(res, ref):
+    """Differences in the photo-z quantities to the reference precision."""
+
+    (_, pzcat), (_, pzcat_ref) = res, ref
+    dzb = np.abs(pzcat.zb - pzcat_ref.zb) / (1 + pzcat_ref.zb)
+    dodds = np.abs(pzcat.odds - pzcat_ref.odds)
+    dqz = np.abs(pzcat.qz - pzcat_ref.qz) / np.abs(pzcat_ref.qz)
+
+    return {'frac_same_zb': (pzcat.zb == pzcat_ref.zb).mean(),
+            'dzb_max': dzb.max(),
+            'frac_dzb_0p01': (dzb > 0.01).mean(),
+            'dodds_median': dodds.median(),
+            'dodds_max': dodds.max(),
+            'dqz_rel_median': dqz.median(),
+            'dqz_rel_max': dqz.max()}
+
+def compare_dtypes(galcat, modelD, fit_bands, dtypes=(np.float64, np.float32),
+                   odds_lim=0.01, width_frac=0.01, **config):
+    """Compare the photo-z quantities when fitting in different precision.
+
+       Args:
+           galcat (df): Reference sample of the galaxy catalogue.
+           modelD (dict): Dictionary containing all the flux models.
+           fit_bands (list): List of bands to fit.
+           dtypes (list): Floating point types. The first is the reference.
+           odds_lim (float): Limit for estimating the ODDS.
+           width_frac (float): Limit when estimating the pz_width.
+           config (dict): Other options passed to minimize_all_z.
+    """
+
+    configD = {np.dtype(dtype).name: {'dtype': dtype} for dtype in dtypes}
+
+    return _compare(galcat, modelD, fit_bands, configD, _dtype_stats, 'dtype',
+                    odds_lim, width_frac, **config)
+
+def _screening_stats(res, ref):
+    """Differences in the best fit to the exhaustive minimization."""
+
+    (chi2, pzcat), (chi2_ref, pzcat_ref) = res, ref
+    dzb = np.abs(pzcat.zb - pzcat_ref.zb) / (1 + pzcat_ref.zb)
+    dchi2_min = chi2.min(dim=['run', 'z']) - chi2_ref.min(dim=['run', 'z'])
+
+    return {'frac_same_best_run': (pzcat.best_run == pzcat_ref.best_run).mean(),
+            'frac_same_zb': (pzcat.zb == pzcat_ref.zb).mean(),
+            'dzb_max': dzb.max(),
+            'frac_dzb_0p01': (dzb > 0.01).mean(),
+            'dchi2_min_max': np.abs(dchi2_min).max(),
+            'dodds_max': np.abs(pzcat.odds - pzcat_ref.odds).max()}
+
+def compare_screening(galcat, modelD, fit_bands, screen_runs=(1, 3, 5, 10),
+                      odds_lim=0.01, width_frac=0.01, **config):
+    """Compare the run pre-screening against the exhaustive minimization.
+
+       Args:
+           galcat (df): Reference sample of the galaxy catalogue.
+           modelD (dict): Dictionary containing all the flux models.
+           fit_bands (list): List of bands to fit.
+           screen_runs (list): Number of runs to keep in the screening.
+           odds_lim (float): Limit for estimating the ODDS.
+           width_frac (float): Limit when estimating the pz_width.
+           config (dict): Other options passed to minimize_all_z, e.g.
+                          screen_dchi2 and screen_niter.
+    """
+
+    configD = {'all': {}}
+    configD.update({n_keep: {'screen_runs': n_keep} for n_keep in screen_runs})
+
+    return _compare(galcat, modelD, fit_bands, configD, _screening_stats,
+                    'screen_runs', odds_lim, width_frac, **config)
@@ -0,0 +1,1184 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Core of the template fitting, working only on plain Numpy arrays. The
+# photo-z and calibration code are wrappers converting from and to xarray.
+#
+# The arrays have the dimensions:
+#   flux, var_inv: (galaxy, band)
+#   f_mod: (z, band, sed)
+#
+# and the minimization is done independently in each (galaxy, z) cell. The
+# computations follow the dtype of the input, which can be float32 to save
+# memory and bandwidth.
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+from . import libmult
+from . import libnnls
+from . import libsym
+
+def normalize_model(f_mod):
+    """Normalize the model fluxes for each SED.
+
+       Args:
+           f_mod (array): Model fluxes with shape (z, band, sed).
+    """
+
+    # Normalizing the models to avoid too large numbers.
+    f_mod = f_mod / f_mod.max(axis=(0, 1))
+
+    # To avoid very low numbers which would result in a large amplitude...
+    f_mod = np.where(f_mod > 1e-3, f_mod, 0)
+
+    return f_mod
+
+def prepare_model(f_mod, nb_mask, products=True):
+    """Precompute the model quantities used in the fit.
+
+       The result only depends on the model and can be reused for all
+       galaxies, for example by scattering it to the workers once. The model
+       is split in narrow and broad bands, with the band as the first axis,
+       and the products of the SEDs are stored in packed symmetric form. The
+       normal matrices then become a single matrix product with the inverse
+       variances.
+
+       Args:
+           f_mod (array): Normalized model with shape (z, band, sed).
+           nb_mask (array): Which bands are narrow bands.
+           products (bool): Store the products of the SEDs, which are only
+                            used when fitting on a redshift grid.
+    """
+
+    nb_mask = np.asarray(nb_mask, dtype=bool)
+
+    model = {'nb_mask': nb_mask}
+    for label, mask in [('NB', nb_mask), ('BB', ~nb_mask)]:
+        f = np.ascontiguousarray(f_mod[:, mask].transpose(1, 0, 2))
+        model[f'f_{label}'] = f
+        if products:
+            model[f'ff_{label}'] = libsym.outer(f)
+
+    return model
+
+def _select_z(model, iz):
+    """The prepared model at the redshift indices iz."""
+
+    return {key: (val if key == 'nb_mask' else val[:, iz])
+            for key, val in model.items()}
+
+def _split_galaxies(flux, var_inv, nb_mask):
+    """Split the galaxy arrays in narrow and broad bands."""
+
+    nb_mask = np.asarray(nb_mask, dtype=bool)
+    gal = (flux[:, nb_mask], flux[:, ~nb_mask], var_inv[:, nb_mask],
+           var_inv[:, ~nb_mask])
+
+    return gal
+
+def _as_model(f_mod, nb_mask, products=True):
+    """Supporting both the raw and the prepared models."""
+
+    if isinstance(f_mod, dict):
+        assert (f_mod['nb_mask'] == np.asarray(nb_mask, dtype=bool)).all()
+        return f_mod
+
+    return prepare_model(f_mod, nb_mask, products)
+
+def _cell_bytes(nband, nmodel, itemsize=8):
+    """Approximate memory needed for each (galaxy, z) cell in bytes, with
+       entries of the given itemsize.
+    """
+
+    # The A_NB and A_BB matrices, stored in packed form, and the unpacked A
+    # dominate. In addition come the vectors in the minimization. The chi2
+    # is found without the model fluxes.
+    return itemsize*(2*libsym.npacked(nmodel) + nmodel**2 + 10*nmodel)
+
+def _chunk_sizes(ngal, nz, nbytes_cell, mem_limit):
+    """Number of galaxies and redshifts to process in each block.
+
+       Args:
+           ngal (int): Number of galaxies.
+           nz (int): Number of redshift steps.
+           nbytes_cell (int): Memory in bytes for each (galaxy, z) cell.
+           mem_limit (float): Memory budget in MB. None means no limit.
+    """
+
+    # At least one, since an empty partition still loops over the blocks.
+    if mem_limit is None:
+        return max(1, ngal), max(1, nz)
+
+    # First split over galaxies, since the redshift grid is fit together.
+    ncells = max(1, int(mem_limit*1e6 / nbytes_cell))
+    if nz <= ncells:
+        return max(1, min(ngal, ncells // nz)), nz
+    else:
+        return 1, ncells
+
+def _start_values(v0, k0, shape, dtype, restored=None):
+    """Initial amplitudes and NB versus BB scaling for each cell.
+
+       Entries without a valid start get the default values. Since the
+       multiplicative updates can not grow a zero or vanishing amplitude,
+       the amplitudes start at least at a small fraction of the largest
+       amplitude in the cell. Cells marked as restored, which have a stored
+       k0, instead keep the amplitudes as given, so a cell restarted from
+       its own solution starts converged.
+    """
+
+    v = 100*np.ones(shape, dtype=dtype)
+    k = np.ones(shape[0], dtype=dtype)
+
+    # Comparisons with NaN entries would otherwise warn.
+    with np.errstate(invalid='ignore'):
+        if v0 is not None:
+            v0 = np.asarray(v0, dtype=dtype)
+            v_max = v0.max(axis=1, keepdims=True)
+            use = (v_max > 0) & np.isfinite(v_max)
+            v_floor = np.maximum(v0, 1e-3*v_max)
+            if restored is not None:
+                v_floor = np.where(restored[:,np.newaxis], v0, v_floor)
+
+            v = np.where(use, v_floor, v)
+
+        if k0 is not None:
+            k0 = np.asarray(k0, dtype=dtype)
+            k = np.where(np.isfinite(k0), np.clip(k0, 0.1, 10), k)
+
+    return v, k
+
+def _update_k(k_method, S1, C_NB, A_NB, b_NB, v):
+    """New scaling between the narrow and broad bands."""
+
+    if k_method == 'ratio':
+        # Testing a new form for scaling the amplitude...
+        S2 = (C_NB*v).sum(axis=1)
+        k = S1 / S2
+    elif k_method == 'lsq':
+        # Minimizing the chi2 for fixed amplitudes.
+        S1 = (b_NB*v).sum(axis=1)
+        S2 = libsym.quad(A_NB, v)
+        k = S1 / S2
+    else:
+        raise ValueError(f'Unknown k_method: {k_method}')
+
+    # Just to avoid crazy values ...
+    k = np.clip(k, 0.1, 10)
+
+    return k
+
+def _minimize_mult(A_NB, A_BB, b_NB, b_BB, S1, C_NB, Niter, Nskip, tol=None,
+                   k_method='ratio', v0=None, k0=None, i_start=0):
+    """Minimize using the multiplicative update rule.
+
+       With a tolerance, the cells where the relative change in the amplitudes
+       since the last NB versus BB scaling is below tol are removed from the
+       later iterations. A_NB and A_BB are in packed form, while the combined
+       matrix is unpacked for faster products. The iterations can be started
+       from the amplitudes v0 and scaling k0, e.g. from a previous fit, and
+       continue a minimization which already ran i_start iterations.
+    """
+
+    ncell = len(b_NB)
+
+    # Since we need these entries in the beginning...
+    v = 100*np.ones_like(b_NB) if v0 is None else v0.astype(b_NB.dtype)
+    k = np.ones(ncell, dtype=b_NB.dtype) if k0 is None else k0.astype(b_NB.dtype)
+    b = b_BB + k[:,np.newaxis]*b_NB
+    A = libsym.unpack(A_BB + k[:,np.newaxis]**2*A_NB)
+
+    # Results for the cells which are no longer iterated.
+    v_out = np.zeros_like(v)
+    k_out = np.ones_like(k)
+    n_iter = Niter*np.ones(ncell, dtype=int)
+    active = np.arange(ncell)
+    v_check = v
+
+    # Smallest amplitude when estimating the relative change.
+    v_min = max(1e-100, float(np.finfo(v.dtype).tiny))
+
+    for i in range(Niter):
+        a = np.einsum('gst,gt->gs', A, v)
+
+        m0 = b / a
+        m0 = np.nan_to_num(m0)
+
+        vn = m0*v
+
+        # Extra step for the amplitude
+        if 0 < i + i_start and (i + i_start) % Nskip == 0:
+            # When continuing, the first check has no earlier amplitudes.
+            if tol is not None and 0 < i:
+                rel_change = np.abs(vn - v_check) / np.maximum(np.abs(v_check), v_min)
+                done = ~(rel_change > tol).any(axis=1)
+
+                if done.any():
+                    v_out[active[done]] = vn[done]
+                    k_out[active[done]] = k[done]
+                    n_iter[active[done]] = i+1
+
+                    keep = ~done
+                    active = active[keep]
+                    vn, k, S1, C_NB = vn[keep], k[keep], S1[keep], C_NB[keep]
+                    A_NB, A_BB = A_NB[keep], A_BB[keep]
+                    b_NB, b_BB = b_NB[keep], b_BB[keep]
+
+                    if not len(active):
+                        v = vn
+                        break
+
+            k = _update_k(k_method, S1, C_NB, A_NB, b_NB, vn)
+
+            b = b_BB + k[:,np.newaxis]*b_NB
+            A = libsym.unpack(A_BB + k[:,np.newaxis]**2*A_NB)
+            v_check = vn
+
+        v = vn
+
+    v_out[active] = v
+    k_out[active] = k
+
+    return v_out, k_out, n_iter
+
+def _nnls_profile(k, A_NB, A_BB, b_NB, b_BB, v_prev=None):
+    """Exact amplitudes for a given NB versus BB scaling and the chi2 up to
+       a constant.
+    """
+
+    b = b_BB + k[:,np.newaxis]*b_NB
+    A = libsym.unpack(A_BB + k[:,np.newaxis]**2*A_NB)
+
+    P = None if v_prev is None else (v_prev > 0)
+    v = libnnls.nnls(A, b, P)
+
+    # At the minimum v^T A v = b^T v.
+    chi2 = -(b*v).sum(axis=1)
+
+    return chi2, v
+
+def _minimize_nnls(A_NB, A_BB, b_NB, b_BB, S1, C_NB, Niter, Nskip, tol=None,
+                   k_method='ratio', v0=None, k0=None, i_start=0):
+    """Minimize using an exact NNLS solver.
+
+       For a fixed NB versus BB scaling the amplitudes are found exactly. The
+       scaling is then found by minimizing the chi2 over log(k) in the range
+       [0.1, 10], first on a coarse grid and then with a golden section
+       search until the scaling is known to a relative precision of tol
+       (default 1e-4). The ratio used for the scaling in the multiplicative
+       updates is not used, since combined with exact amplitudes it runs off
+       to the clipping limits. Niter, Nskip, k_method, the start values and
+       i_start are not used, and the returned n_iter is the number of NNLS
+       solutions.
+    """
+
+    ncell = len(b_NB)
+    tol = 1e-4 if tol is None else tol
+    args = (A_NB, A_BB, b_NB, b_BB)
+
+    # Coarse grid to find the bracket.
+    k_grid = np.geomspace(0.1, 10, 9)
+    L = [_nnls_profile(np.full(ncell, x), *args) for x in k_grid]
+    chi2_grid = np.array([x[0] for x in L])
+    v_grid = np.array([x[1] for x in L])
+
+    ibest = chi2_grid.argmin(axis=0)
+    cells = np.arange(ncell)
+    chi2_best, v_best = chi2_grid[ibest, cells], v_grid[ibest, cells]
+    k_best = k_grid[ibest]
+
+    log_k = np.log(k_grid)
+    lo = log_k[np.clip(ibest-1, 0, len(k_grid)-1)]
+    hi = log_k[np.clip(ibest+1, 0, len(k_grid)-1)]
+
+    # Golden section search within the bracket.
+    invphi = (np.sqrt(5) - 1) / 2
+    x1 = hi - invphi*(hi - lo)
+    x2 = lo + invphi*(hi - lo)
+    f1, v1 = _nnls_profile(np.exp(x1), *args, v_best)
+    f2, v2 = _nnls_profile(np.exp(x2), *args, v_best)
+
+    nstep = int(np.ceil(np.log(tol / (log_k[2] - log_k[0])) / np.log(invphi)))
+    for i in range(max(0, nstep)):
+        left = f1 < f2
+        hi = np.where(left, x2, hi)
+        lo = np.where(left, lo, x1)
+
+        x_new = np.where(left, hi - invphi*(hi - lo), lo + invphi*(hi - lo))
+        v_prev = np.where(left[:,np.newaxis], v1, v2)
+        f_new, v_new = _nnls_profile(np.exp(x_new), *args, v_prev)
+
+        # Shift the interior points. Going left, the new point becomes x1
+        # and x1 becomes x2. Otherwise x2 becomes x1 and the new point x2.
+        left_v = left[:,np.newaxis]
+        x1, f1, v1, x2, f2, v2 = (
+            np.where(left, x_new, x2), np.where(left, f_new, f2),
+            np.where(left_v, v_new, v2),
+            np.where(left, x1, x_new), np.where(left, f1, f_new),
+            np.where(left_v, v1, v_new))
+
+    # Including the grid in case of several minima.
+    for x, f, v in [(x1, f1, v1), (x2, f2, v2)]:
+        better = f < chi2_best
+        chi2_best = np.where(better, f, chi2_best)
+        k_best = np.where(better, np.exp(x), k_best)
+        v_best = np.where(better[:,np.newaxis], v, v_best)
+
+    n_iter = (len(k_grid) + 2 + max(0, nstep))*np.ones(ncell, dtype=int)
+
+    return v_best, k_best, n_iter
+
+engines = {'mult': _minimize_mult, 'nnls': _minimize_nnls}
+
+def _minimize(A_NB, A_BB, b_NB, b_BB, S1, C_NB, config, start=None, i_start=0):
+    """Run the selected minimization engine. When continuing after i_start
+       iterations, the start values are used as given.
+    """
+
+    engine = config.get('engine', 'mult')
+    minimize = engines[engine]
+
+    # The compiled kernel when available.
+    if engine == 'mult' and config.get('use_numba', True) and libmult.HAS_NUMBA:
+        minimize = partial(libmult.minimize_mult,
+                           parallel=config.get('numba_parallel', True))
+
+    v0, k0 = (None, None) if start is None else start
+    k_method = config.get('k_method', 'ratio')
+
+    # Cells with a stored scaling are restored as given.
+    restored = None if k0 is None else np.isfinite(np.asarray(k0, dtype=float))
+    if v0 is not None and (restored is None or not restored.all()):
+        # The scaling consistent with the start amplitudes.
+        with np.errstate(all='ignore'):
+            valid = np.isfinite(v0).all(axis=1) & (0 < v0.max(axis=1))
+            k_v = _update_k(k_method, S1, C_NB, A_NB, b_NB, np.nan_to_num(v0))
+            k_v = np.where(valid, k_v, np.nan)
+
+        k0 = k_v if k0 is None else np.where(restored, k0, k_v)
+
+    if start is not None and not i_start:
+        v0, k0 = _start_values(v0, k0, b_NB.shape, b_NB.dtype, restored)
+
+        # A restored cell continues a minimization which stopped at a
+        # check, so the next check comes after Nskip iterations.
+        if restored is not None and restored.any():
+            i_start = 1
+
+    v, k, n_iter = minimize(A_NB, A_BB, b_NB, b_BB, S1, C_NB, config['Niter'],
+                            config['Nskip'], config.get('tol'), k_method,
+                            v0=v0, k0=k0, i_start=i_start)
+
+    return v, k, n_iter
+
+def _chi2_normal(wff, A_NB, A_BB, b_NB, b_BB, v, k):
+    """The chi2 from the normal equations, without the model fluxes.
+
+       With A = A_BB + k^2 A_NB and b = b_BB + k b_NB, the chi2 is
+       sum(w f^2) - 2 b.v + v^T A v.
+    """
+
+    bv = (b_BB*v).sum(axis=1) + k*(b_NB*v).sum(axis=1)
+    vAv = libsym.quad(A_BB, v) + k**2*libsym.quad(A_NB, v)
+
+    return wff - 2*bv + vAv
+
+def _chi2_bound(wff_NB, wff_BB, A_NB, A_BB, b_NB, b_BB):
+    """Lower bound on the chi2 of each cell.
+
+       Fitting the narrow and broad bands with independent amplitudes,
+       without the positivity constraint, can only lower the chi2.
+    """
+
+    bound = wff_NB + wff_BB
+    for A, b in [(A_NB, b_NB), (A_BB, b_BB)]:
+        A = libsym.unpack(A).astype(np.float64)
+        x = np.einsum('cst,ct->cs', np.linalg.pinv(A, hermitian=True), b)
+        bound = bound - (b*x).sum(axis=1)
+
+    return bound
+
+def _minimize_pruned(A_NB, A_BB, b_NB, b_BB, S1, C_NB, config, start, chi2_cells,
+                     bound, igal):
+    """Minimize while freezing the cells which cannot contribute to the p(z).
+
+       Every prune_every iterations, the cells with a chi2 lower bound more
+       than -2 ln(prune_floor) above the current best chi2 of the galaxy
+       are no longer iterated.
+    """
+
+    Niter = config['Niter']
+    every = config.get('prune_every', 100)
+    dchi2 = -2*np.log(config['prune_floor'])
+
+    v = np.zeros_like(b_NB)
+    k = np.ones(len(b_NB), dtype=b_NB.dtype)
+    n_iter = np.zeros(len(b_NB), dtype=int)
+
+    arrays = (A_NB, A_BB, b_NB, b_BB, S1, C_NB)
+    active = np.arange(len(b_NB))
+
+    # Restored cells start one iteration later, see _minimize.
+    offset = int(start is not None and start[1] is not None and
+                 bool(np.isfinite(start[1]).any()))
+    i = 0
+    while len(active) and i < Niter:
+        niter_step = min(every, Niter - i)
+        start_step = _slice_start(start, active) if i == 0 else (v[active], k[active])
+
+        v[active], k[active], n = _minimize(*(x[active] for x in arrays),
+            dict(config, Niter=niter_step), start_step, i + offset if i else 0)
+
+        n_iter[active] += n
+        i += niter_step
+
+        # Cells stopped by the tolerance.
+        active = active[n == niter_step]
+
+        # The best chi2 so far for each galaxy.
+        chi2 = chi2_cells(v, k)
+        best = np.full(igal.max() + 1, np.inf, dtype=chi2.dtype)
+        np.minimum.at(best, igal, chi2)
+
+        active = active[bound[active] <= best[igal[active]] + dchi2]
+
+    return v, k, n_iter
+
+def _solve(A_NB, A_BB, b_NB, b_BB, S1, C_NB, wff_NB, wff_BB, igal, config,
+           start=None):
+    """Minimize the cells and estimate the chi2. The galaxy index of each
+       cell is only used when pruning.
+    """
+
+    wff = wff_NB + wff_BB
+    chi2_cells = partial(_chi2_normal, wff, A_NB, A_BB, b_NB, b_BB)
+
+    if config.get('prune_floor') is None or config.get('engine', 'mult') != 'mult':
+        v, k, n_iter = _minimize(A_NB, A_BB, b_NB, b_BB, S1, C_NB, config, start)
+    else:
+        bound = _chi2_bound(wff_NB, wff_BB, A_NB, A_BB, b_NB, b_BB)
+        v, k, n_iter = _minimize_pruned(A_NB, A_BB, b_NB, b_BB, S1, C_NB, config,
+                                        start, chi2_cells, bound, igal)
+
+    return chi2_cells(v, k), v, k, n_iter
+
+def _matmul(w, f):
+    """Contract the band, which is the first axis of f."""
+
+    return (w @ f.reshape((len(f), -1))).reshape((len(w),) + f.shape[1:])
+
+def _core_block(model, flux_NB, flux_BB, var_inv_NB, var_inv_BB, config,
+                start=None):
+    """Minimize the chi2 expression for a block of galaxies and redshifts.
+
+       Internally the (galaxy, z) cells are flattened.
+    """
+
+    ngal, nz, nmodel = len(flux_NB), model['f_NB'].shape[1], model['f_NB'].shape[2]
+    shape_A = (ngal*nz, libsym.npacked(nmodel))
+    shape_b = (ngal*nz, nmodel)
+
+    # The models are kept dense, also for the emission line SEDs with few
+    # non-zero entries. Measured with 46 bands, 2400 redshifts, 10 SEDs and
+    # 200 galaxies, these products took 0.3s of the 76s total. Being memory
+    # bound on the output, sparse layouts were all slower: scipy CSR (1.5x),
+    # ELL gathers in Numpy (3x) and Numba (1.3x) and compacting the zero
+    # columns (2.5-3x). The amplitudes in the iterations are dense anyway.
+    A_NB = _matmul(var_inv_NB, model['ff_NB']).reshape(shape_A)
+    b_NB = _matmul(var_inv_NB*flux_NB, model['f_NB']).reshape(shape_b)
+    A_BB = _matmul(var_inv_BB, model['ff_BB']).reshape(shape_A)
+    b_BB = _matmul(var_inv_BB*flux_BB, model['f_BB']).reshape(shape_b)
+
+    # Testing to scale to the narrow bands. In that case the code above is not needed.
+    S1 = np.repeat((var_inv_NB*flux_NB).sum(axis=1), nz)
+    C_NB = _matmul(var_inv_NB, model['f_NB']).reshape(shape_b)
+
+    if start is not None:
+        start = _flatten_start(start, ngal*nz)
+
+    wff_NB = np.repeat((var_inv_NB*flux_NB**2).sum(axis=1), nz)
+    wff_BB = np.repeat((var_inv_BB*flux_BB**2).sum(axis=1), nz)
+    igal = np.repeat(np.arange(ngal), nz)
+
+    chi2, v, k, n_iter = _solve(A_NB, A_BB, b_NB, b_BB, S1, C_NB, wff_NB,
+                                wff_BB, igal, config, start)
+
+    v = v.reshape((ngal, nz, nmodel))
+    k = k.reshape((ngal, nz))
+    chi2 = chi2.reshape((ngal, nz))
+    n_iter = n_iter.reshape((ngal, nz))
+
+    return chi2, v, k, n_iter
+
+def _core_cells(model, flux_NB, flux_BB, var_inv_NB, var_inv_BB, config,
+                igal, start=None):
+    """Minimize the chi2 expression for a list of (galaxy, z) cells.
+
+       Here both the model and the galaxy arrays have one entry per cell,
+       and igal gives the galaxy of each cell.
+    """
+
+    A_NB = np.einsum('cf,fcp->cp', var_inv_NB, libsym.outer(model['f_NB']))
+    b_NB = np.einsum('cf,cf,fcs->cs', var_inv_NB, flux_NB, model['f_NB'])
+    A_BB = np.einsum('cf,fcp->cp', var_inv_BB, libsym.outer(model['f_BB']))
+    b_BB = np.einsum('cf,cf,fcs->cs', var_inv_BB, flux_BB, model['f_BB'])
+
+    S1 = (var_inv_NB*flux_NB).sum(axis=1)
+    C_NB = np.einsum('cf,fcs->cs', var_inv_NB, model['f_NB'])
+
+    wff_NB = (var_inv_NB*flux_NB**2).sum(axis=1)
+    wff_BB = (var_inv_BB*flux_BB**2).sum(axis=1)
+
+    return _solve(A_NB, A_BB, b_NB, b_BB, S1, C_NB, wff_NB, wff_BB, igal,
+                  config, start)
+
+def _flatten_start(start, ncell):
+    """Start values with the (galaxy, z) cells flattened."""
+
+    v0, k0 = start
+    v0 = None if v0 is None else v0.reshape((ncell, -1))
+    k0 = None if k0 is None else k0.reshape(ncell)
+
+    return v0, k0
+
+def _slice_start(start, *index):
+    """Start values for part of the cells."""
+
+    if start is None:
+        return None
+
+    return tuple(None if x is None else x[index] for x in start)
+
+def _fit_grid(model, gal, iz, config, start=None):
+    """Minimize all galaxies at the redshift indices iz. The optional start
+       values have the shape (galaxy, iz, sed) and (galaxy, iz).
+    """
+
+    flux_NB, flux_BB, var_inv_NB, var_inv_BB = gal
+    model = _select_z(model, iz)
+
+    ngal, nz, nmodel = len(flux_NB), model['f_NB'].shape[1], model['f_NB'].shape[2]
+    nband = len(model['nb_mask'])
+    dtype = np.result_type(model['f_NB'], flux_NB)
+    nbytes_cell = _cell_bytes(nband, nmodel, dtype.itemsize)
+    gal_chunk, z_chunk = _chunk_sizes(ngal, nz, nbytes_cell, config.get('mem_limit'))
+
+    chi2 = np.zeros((ngal, nz), dtype=dtype)
+    v = np.zeros((ngal, nz, nmodel), dtype=dtype)
+    k = np.zeros((ngal, nz), dtype=dtype)
+    n_iter = np.zeros((ngal, nz), dtype=int)
+    for i in range(0, ngal, gal_chunk):
+        G = slice(i, i+gal_chunk)
+        for j in range(0, nz, z_chunk):
+            Z = slice(j, j+z_chunk)
+            chi2[G,Z], v[G,Z], k[G,Z], n_iter[G,Z] = _core_block(
+                _select_z(model, Z), flux_NB[G], flux_BB[G],
+                var_inv_NB[G], var_inv_BB[G], config, _slice_start(start, G, Z))
+
+    return chi2, v, k, n_iter
+
+def _fit_cells(model, gal, igal, iz, config, start=None):
+    """Minimize a list of (galaxy, z) cells, with optional start values
+       for each cell.
+    """
+
+    flux_NB, flux_BB, var_inv_NB, var_inv_BB = gal
+
+    nmodel = model['f_NB'].shape[2]
+    nband = len(model['nb_mask'])
+
+    # The model is expanded for each cell.
+    dtype = np.result_type(model['f_NB'], flux_NB)
+    nbytes_cell = _cell_bytes(nband, nmodel, dtype.itemsize) + \
+                  dtype.itemsize*nband*(nmodel + libsym.npacked(nmodel))
+    chunk, _ = _chunk_sizes(len(igal), 1, nbytes_cell, config.get('mem_limit'))
+
+    chi2 = np.zeros(len(igal), dtype=dtype)
+    v = np.zeros((len(igal), nmodel), dtype=dtype)
+    k = np.zeros(len(igal), dtype=dtype)
+    n_iter = np.zeros(len(igal), dtype=int)
+    for i in range(0, len(igal), chunk):
+        C = slice(i, i+chunk)
+        G, Z = igal[C], iz[C]
+        chi2[C], v[C], k[C], n_iter[C] = _core_cells(
+            _select_z(model, Z), flux_NB[G], flux_BB[G],
+            var_inv_NB[G], var_inv_BB[G], config, G, _slice_start(start, C))
+
+    return chi2, v, k, n_iter
+
+def _interp_coarse(X, iz_coarse, nz):
+    """Linear interpolation from the coarse to the fine redshift grid."""
+
+    iz = np.arange(nz)
+    j = np.clip(np.searchsorted(iz_coarse, iz, side='right') - 1, 0, len(iz_coarse) - 2)
+    t = (iz - iz_coarse[j]) / (iz_coarse[j+1] - iz_coarse[j])
+
+    # Broadcasting over any trailing dimensions.
+    t = t.reshape((1, nz) + (1,)*(X.ndim - 2))
+
+    return ((1 - t)*X[:, j] + t*X[:, j+1]).astype(X.dtype)
+
+def _refine_cells(chi2_coarse, iz_coarse, nz, npeaks, width):
+    """The (galaxy, z) cells to refine around the peaks in the coarse p(z).
+
+       Args:
+           chi2_coarse (array): Chi2 on the coarse grid with shape (run, galaxy, z).
+           iz_coarse (array): Fine grid indices of the coarse grid.
+           nz (int): Number of fine redshift steps.
+           npeaks (int): Number of peaks to refine for each galaxy.
+           width (int): Half width of the windows in fine grid steps.
+    """
+
+    chi2_min = chi2_coarse.min(axis=(0, 2), keepdims=True)
+    pz = np.exp(-0.5*(chi2_coarse - chi2_min)).sum(axis=0)
+
+    # Local maxima, where the plateaus count once.
+    padded = np.pad(pz, ((0, 0), (1, 1)), constant_values=-1)
+    is_peak = (padded[:, :-2] <= pz) & (padded[:, 2:] < pz)
+    score = np.where(is_peak, pz, -1)
+    top = np.argsort(-score, axis=1)[:, :npeaks]
+    valid = 0 <= np.take_along_axis(score, top, axis=1)
+
+    iz = np.arange(nz)
+    to_refine = np.zeros((len(pz), nz), dtype=bool)
+    for j in range(top.shape[1]):
+        center = iz_coarse[top[:, j]][:, np.newaxis]
+        in_window = (center - width <= iz) & (iz <= center + width)
+        to_refine |= valid[:, j, np.newaxis] & in_window
+
+    # These are already fitted.
+    to_refine[:, iz_coarse] = False
+    igal, iz = np.nonzero(to_refine)
+
+    return igal, iz
+
+def _pack_runs(modelL):
+    """Pack the models of several runs into a single model.
+
+       The runs are stacked along the redshift axis and the SEDs are padded
+       with zeros up to the largest number of SEDs. The mask marks the SEDs
+       actually present in each run.
+    """
+
+    nmodel = max(x['f_NB'].shape[2] for x in modelL)
+    sed_mask = np.array([np.arange(nmodel) < x['f_NB'].shape[2] for x in modelL])
+
+    if len(modelL) == 1:
+        return modelL[0], sed_mask
+
+    def pad(f):
+        return np.pad(f, ((0, 0), (0, 0), (0, nmodel - f.shape[-1])))
+
+    packed = {'nb_mask': modelL[0]['nb_mask']}
+    for label in ['NB', 'BB']:
+        f = np.concatenate([pad(x[f'f_{label}']) for x in modelL], axis=1)
+        packed[f'f_{label}'] = f
+        if f'ff_{label}' in modelL[0]:
+            packed[f'ff_{label}'] = libsym.outer(f)
+
+    return packed, sed_mask
+
+def _pack_start(startL, sed_mask, axis):
+    """Pack the start values of several runs, concatenated along the given
+       axis as the models in _pack_runs. Missing values are set to NaN, which
+       gives the default start.
+    """
+
+    if startL is None or all(x is None for x in startL):
+        return None
+
+    v0, k0 = next(x for x in startL if x is not None)
+    shape = (k0.shape if v0 is None else v0.shape[:-1]) + (sed_mask.shape[1],)
+
+    VL, KL = [], []
+    for start, mask in zip(startL, sed_mask):
+        v0, k0 = (None, None) if start is None else start
+
+        # The padded SEDs have no flux, so their amplitude does not matter.
+        v = np.full(shape, np.nan)
+        if v0 is not None:
+            v[...] = 0.
+            v[..., mask] = v0
+
+        VL.append(v)
+        KL.append(np.full(shape[:-1], np.nan) if k0 is None else k0)
+
+    return np.concatenate(VL, axis=axis), np.concatenate(KL, axis=axis)
+
+def _unpack_runs(chi2, v, k, n_iter, sed_mask):
+    """Split the results into the runs. The redshift axis is the second."""
+
+    nrun = len(sed_mask)
+    shape = (len(chi2), nrun, chi2.shape[1] // nrun)
+    chi2 = chi2.reshape(shape)
+    k = k.reshape(shape)
+    n_iter = n_iter.reshape(shape)
+    v = v.reshape(shape + (v.shape[2],))
+
+    L = []
+    for i, mask in enumerate(sed_mask):
+        L.append((chi2[:, i], v[:, i][:, :, mask], k[:, i], n_iter[:, i]))
+
+    return L
+
+def _map_groups(func, groups, config):
+    """Apply func to each group of runs, optionally on a thread pool.
+
+       Numpy releases the GIL in the heavy operations. When using threads,
+       the BLAS and the compiled kernel are limited to a single thread each
+       to avoid oversubscribing the cores.
+    """
+
+    n_threads = config.get('n_threads')
+    if not n_threads or n_threads == 1 or len(groups) == 1:
+        return [func(group, config) for group in groups]
+
+    config = dict(config, numba_parallel=False)
+    limits = nullcontext() if threadpool_limits is None else \
+             threadpool_limits(limits=1, user_api='blas')
+
+    with limits, ThreadPoolExecutor(max_workers=n_threads) as pool:
+        return list(pool.map(partial(func, config=config), groups))
+
+def _minimize_grid(groups, modelL, gal, config, startL=None):
+    """Fit all runs on the full redshift grid."""
+
+    def fit_group(group, config):
+        packed, sed_mask = _pack_runs([modelL[i] for i in group])
+        start = _pack_start(_select_runs(startL, group), sed_mask, axis=1)
+        iz = np.arange(packed['f_NB'].shape[1])
+        res = _fit_grid(packed, gal, iz, config, start)
+
+        return _unpack_runs(*res, sed_mask)
+
+    R = {}
+    for group, res in zip(groups, _map_groups(fit_group, groups, config)):
+        R.update(zip(group, res))
+
+    return [R[i] for i in range(len(modelL))]
+
+def _select_runs(startL, group, *index):
+    """Start values for a group of runs."""
+
+    if startL is None:
+        return None
+
+    return [_slice_start(startL[i], *index) if index else startL[i] for i in group]
+
+def _coarse_grid(nz, z_step):
+    """Indices of the coarse redshift grid, including both ends."""
+
+    iz_coarse = np.arange(0, nz, z_step)
+    if iz_coarse[-1] != nz - 1:
+        iz_coarse = np.append(iz_coarse, nz - 1)
+
+    return iz_coarse
+
+def _minimize_coarse_fine(groups, modelL, gal, config, z_step, npeaks, z_width,
+                          startL=None, warm_start=False):
+    """Fit on a coarse redshift grid and refine around the peaks. Without
+       other start values, warm_start starts the refined cells from the
+       amplitudes interpolated from the coarse grid.
+    """
+
+    # Assumes the same redshift grid for all runs.
+    nz = modelL[0]['f_NB'].shape[1]
+    iz_coarse = _coarse_grid(nz, z_step)
+
+    def fit_coarse(group, config):
+        packed, sed_mask = _pack_runs([modelL[i] for i in group])
+        start = _pack_start(_select_runs(startL, group, slice(None), iz_coarse),
+                            sed_mask, axis=1)
+        iz = np.concatenate([j*nz + iz_coarse for j in range(len(group))])
+        res = _fit_grid(packed, gal, iz, config, start)
+
+        return _unpack_runs(*res, sed_mask)
+
+    coarse = {}
+    for group, res in zip(groups, _map_groups(fit_coarse, groups, config)):
+        coarse.update(zip(group, res))
+
+    chi2_coarse = np.array([coarse[i][0] for i in range(len(modelL))])
+    igal, iz = _refine_cells(chi2_coarse, iz_coarse, nz, npeaks, z_width)
+
+    # The regions outside of the peaks are only estimated from the
+    # coarse grid.
+    L = []
+    for i in range(len(modelL)):
+        chi2_c, v_c, k_c, n_iter_c = coarse[i]
+
+        chi2 = _interp_coarse(chi2_c, iz_coarse, nz)
+        v = _interp_coarse(v_c, iz_coarse, nz)
+        k = _interp_coarse(k_c, iz_coarse, nz)
+        n_iter = np.zeros(chi2.shape, dtype=int)
+
+        chi2[:, iz_coarse] = chi2_c
+        v[:, iz_coarse] = v_c
+        k[:, iz_coarse] = k_c
+        n_iter[:, iz_coarse] = n_iter_c
+
+        L.append((chi2, v, k, n_iter))
+
+    # The interpolated amplitudes are not a converged solution, so the
+    # cells are not restored as given and the scaling is recomputed.
+    if startL is None and warm_start:
+        startL = [(v, None) for _, v, _, _ in L]
+
+    def fit_fine(group, config):
+        packed, sed_mask = _pack_runs([modelL[i] for i in group])
+        start = _pack_start(_select_runs(startL, group, igal, iz), sed_mask, axis=0)
+        nrun = len(group)
+        igal_packed = np.tile(igal, nrun)
+        iz_packed = np.concatenate([j*nz + iz for j in range(nrun)])
+        chi2, v, k, n_iter = _fit_cells(packed, gal, igal_packed, iz_packed,
+                                        config, start)
+
+        L = []
+        for j in range(nrun):
+            C = slice(j*len(igal), (j+1)*len(igal))
+            L.append((chi2[C], v[C][:, sed_mask[j]], k[C], n_iter[C]))
+
+        return L
+
+    fine = {}
+    for group, res in zip(groups, _map_groups(fit_fine, groups, config)):
+        fine.update(zip(group, res))
+
+    for i, (chi2, v, k, n_iter) in enumerate(L):
+        chi2[igal, iz], v[igal, iz], k[igal, iz], n_iter[igal, iz] = fine[i]
+
+    return L
+
+def _screen_runs(groups, modelL, gal, config, n_keep, dchi2, Niter, z_step):
+    """Select the runs to fully minimize for each galaxy.
+
+       All runs are first minimized with Niter iterations on a coarse
+       redshift grid. The n_keep runs with the lowest chi2 are kept, and
+       also the runs within dchi2 of the best one.
+
+       Returns:
+           Mask with shape (run, galaxy).
+    """
+
+    config = dict(config, Niter=Niter, tol=None)
+    nz = modelL[0]['f_NB'].shape[1]
+    iz_coarse = _coarse_grid(nz, z_step)
+
+    def screen_group(group, config):
+        packed, sed_mask = _pack_runs([modelL[i] for i in group])
+        iz = np.concatenate([j*nz + iz_coarse for j in range(len(group))])
+        chi2 = _fit_grid(packed, gal, iz, config)[0]
+
+        return chi2.reshape((len(chi2), len(group), len(iz_coarse))).min(axis=2).T
+
+    chi2 = np.zeros((len(modelL), len(gal[0])))
+    for group, res in zip(groups, _map_groups(screen_group, groups, config)):
+        chi2[group] = res
+
+    rank = np.argsort(np.argsort(chi2, axis=0), axis=0)
+    keep = rank < n_keep
+    if dchi2 is not None:
+        keep |= chi2 - chi2.min(axis=0) <= dchi2
+
+    return keep
+
+def _minimize_screened(groups, modelL, gal, config, keep, fit, startL=None):
+    """Minimize each group of runs only for the galaxies kept in the
+       screening. The other runs get chi2=inf and zero amplitudes.
+    """
+
+    def empty(i, nz, nmodel, dtype):
+        """Output for a run without any kept galaxies."""
+
+        ngal = len(keep[i])
+        return (np.full((ngal, nz), np.inf, dtype=dtype),
+                np.zeros((ngal, nz, nmodel), dtype=dtype),
+                np.ones((ngal, nz), dtype=dtype), np.zeros((ngal, nz), dtype=int))
+
+    def fit_group(group, config):
+        G = np.nonzero(keep[group].any(axis=0))[0]
+        if not len(G):
+            return [empty(i, *modelL[i]['f_NB'].shape[1:],
+                          np.result_type(modelL[i]['f_NB'], gal[0])) for i in group]
+
+        gal_sub = tuple(x[G] for x in gal)
+        start_sub = _select_runs(startL, group, G)
+
+        # The galaxies and runs are already split between the threads.
+        config = dict(config, n_threads=None)
+        resL = fit([list(range(len(group)))], [modelL[i] for i in group],
+                   gal_sub, config, startL=start_sub)
+
+        L = []
+        for i, (chi2_sub, v_sub, k_sub, n_iter_sub) in zip(group, resL):
+            chi2, v, k, n_iter = empty(i, *v_sub.shape[1:], v_sub.dtype)
+            chi2[G], v[G], k[G], n_iter[G] = chi2_sub, v_sub, k_sub, n_iter_sub
+
+            # Also when the galaxy was minimized for another run in the group.
+            chi2[~keep[i]] = np.inf
+            v[~keep[i]] = 0.
+            L.append((chi2, v, k, n_iter))
+
+        return L
+
+    R = {}
+    for group, res in zip(groups, _map_groups(fit_group, groups, config)):
+        R.update(zip(group, res))
+
+    return [R[i] for i in range(len(modelL))]
+
+def _select_bands(model, bands):
+    """The model restricted to a subset of the bands."""
+
+    nb_mask = model['nb_mask']
+    index = {'NB': bands[nb_mask], 'BB': bands[~nb_mask]}
+
+    sub = {'nb_mask': nb_mask[bands]}
+    for key, val in model.items():
+        if key != 'nb_mask':
+            sub[key] = val[index[key[-2:]]]
+
+    return sub
+
+def _band_groups(observed, nb_mask, min_size):
+    """Group the galaxies by the pattern of observed bands.
+
+       The patterns with fewer than min_size galaxies, or without any
+       narrow or broad band, are combined in a group using all bands.
+
+       Returns:
+           List of (galaxy index, band mask) pairs.
+    """
+
+    patterns, inverse = np.unique(observed, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    count = np.bincount(inverse)
+
+    use = (min_size <= count) & patterns[:, nb_mask].any(axis=1) & \
+          patterns[:, ~nb_mask].any(axis=1)
+    group = np.where(use[inverse], inverse, -1)
+
+    L = []
+    for i in np.unique(group):
+        bands = patterns[i] if 0 <= i else np.ones(len(nb_mask), dtype=bool)
+        L.append((np.nonzero(group == i)[0], bands))
+
+    return L
+
+def _fit_band_groups(fit, modelL, flux, var_inv, nb_mask, startL, observed,
+                     min_size):
+    """Minimize each group of galaxies with only their observed bands."""
+
+    nb_mask = np.asarray(nb_mask, dtype=bool)
+    ngal = len(flux)
+
+    # Without galaxies there are no groups to give the output shapes.
+    if not ngal:
+        return fit(modelL, _split_galaxies(flux, var_inv, nb_mask), startL)
+
+    R = None
+    for G, bands in _band_groups(observed, nb_mask, min_size):
+        gal = _split_galaxies(flux[G][:, bands], var_inv[G][:, bands],
+                              nb_mask[bands])
+        modelL_sub = [_select_bands(model, bands) for model in modelL]
+        startL_sub = _select_runs(startL, range(len(modelL)), G)
+
+        resL = fit(modelL_sub, gal, startL_sub)
+        if R is None:
+            R = [tuple(np.zeros((ngal,) + x.shape[1:], dtype=x.dtype) for x in res)
+                 for res in resL]
+
+        for res_all, res in zip(R, resL):
+            for x_all, x in zip(res_all, res):
+                x_all[G] = x
+
+    return R
+
+def fit_arrays(flux, var_inv, f_mod, nb_mask, Niter=1000, Nskip=10, tol=None,
+               engine='mult', mem_limit=None, k_method='ratio', use_numba=True,
+               v0=None, k0=None, prune_floor=None, prune_every=100):
+    """Minimize the chi2 for all galaxies at all redshifts.
+
+       Args:
+           flux (array): Fluxes with shape (galaxy, band).
+           var_inv (array): Inverse variance with shape (galaxy, band).
+           f_mod (array): Normalized model with shape (z, band, sed), or
+                          the output of prepare_model.
+           nb_mask (array): Which bands are narrow bands.
+           Niter (int): Number of iterations in the minimization.
+           Nskip (int): How often to normalize between NB and BB.
+           tol (float): Tolerance for stopping the minimization of a cell.
+           engine (str): Minimization algorithm ('mult' or 'nnls').
+           mem_limit (float): Memory budget (MB) for the minimization.
+           k_method (str): How to scale the NB versus BB ('ratio' or 'lsq').
+           use_numba (bool): Use the compiled kernel for the 'mult' engine
+                             when Numba is installed.
+           v0 (array): Start amplitudes with shape (galaxy, z, sed), e.g. the
+                       norm from a previous fit. Together with tol, this
+                       reduces the number of iterations. NaN entries use the
+                       default start. Not used by the 'nnls' engine.
+           k0 (array): Start NB versus BB scaling with shape (galaxy, z).
+           prune_floor (float): Stop iterating the cells which can not reach
+                                this fraction of the highest p(z) of the
+                                galaxy. Only for the 'mult' engine.
+           prune_every (int): Iterations between checking the cells to prune.
+
+       Returns:
+           chi2 (galaxy, z), norm (galaxy, z, sed), k (galaxy, z) and the
+           number of iterations n_iter (galaxy, z).
+    """
+
+    config = {'Niter': Niter, 'Nskip': Nskip, 'tol': tol, 'engine': engine,
+              'mem_limit': mem_limit, 'k_method': k_method,
+              'use_numba': use_numba, 'prune_floor': prune_floor,
+              'prune_every': prune_every}
+
+    model = _as_model(f_mod, nb_mask)
+    gal = _split_galaxies(flux, var_inv, nb_mask)
+    iz = np.arange(model['f_NB'].shape[1])
+    start = None if v0 is None and k0 is None else (v0, k0)
+
+    return _fit_grid(model, gal, iz, config, start)
+
+def fit_at_z(flux, var_inv, f_mod, nb_mask, Niter=1000, Nskip=10, tol=None,
+             engine='mult', mem_limit=None, k_method='ratio', use_numba=True,
+             v0=None, k0=None):
+    """Minimize the chi2 with one model for each galaxy, for example
+       at the spectroscopic redshift.
+
+       Args:
+           flux (array): Fluxes with shape (galaxy, band).
+           var_inv (array): Inverse variance with shape (galaxy, band).
+           f_mod (array): Normalized model with shape (galaxy, band, sed).
+           v0 (array): Start amplitudes with shape (galaxy, sed).
+           k0 (array): Start NB versus BB scaling with shape (galaxy,).
+           Other arguments as in fit_arrays.
+
+       Returns:
+           chi2 (galaxy), norm (galaxy, sed), k (galaxy) and n_iter (galaxy).
+    """
+
+    config = {'Niter': Niter, 'Nskip': Nskip, 'tol': tol, 'engine': engine,
+              'mem_limit': mem_limit, 'k_method': k_method,
+              'use_numba': use_numba}
+
+    model = _as_model(f_mod, nb_mask, products=False)
+    gal = _split_galaxies(flux, var_inv, nb_mask)
+    cells = np.arange(len(flux))
+    start = None if v0 is None and k0 is None else (v0, k0)
+
+    return _fit_cells(model, gal, cells, cells, config, start)
+
+def fit_runs(flux, var_inv, f_modL, nb_mask, Niter=1000, Nskip=10, tol=None,
+             engine='mult', mem_limit=None, k_method='ratio', use_numba=True,
+             batch_runs=False, z_step=None, npeaks=3, z_width=None,
+             n_threads=None, v0L=None, k0L=None, warm_start=False,
+             screen_runs=None, screen_dchi2=None, screen_niter=50,
+             screen_z_step=10, prune_floor=None, prune_every=100,
+             band_groups=None):
+    """Minimize the chi2 for several runs, each with their own model.
+
+       Args:
+           f_modL (list): Normalized models with shape (z, band, sed), or the
+                          output of prepare_model. All runs should have the
+                          same redshift grid.
+           batch_runs (bool): Minimize all runs together in a single padded
+                              model array.
+           z_step (int): If set, first fit on a redshift grid with this step
+                         and then refine around the peaks in the p(z).
+           npeaks (int): Number of p(z) peaks to refine for each galaxy.
+           z_width (int): Half width of the refined windows in redshift steps.
+                          Defaults to 2*z_step.
+           n_threads (int): Number of threads for fitting the runs in
+                            parallel. The BLAS is then limited to one thread
+                            when threadpoolctl is installed.
+           v0L (list): Start amplitudes for each run, as v0 in fit_arrays.
+                       Entries can be None.
+           k0L (list): Start NB versus BB scaling for each run.
+           warm_start (bool): Start the refined cells from the coarse grid
+                              amplitudes when not giving v0L.
+           screen_runs (int): If set, first rank the runs for each galaxy
+                              with a cheap minimization and only fully
+                              minimize this number of runs. The other runs
+                              get chi2=inf.
+           screen_dchi2 (float): Also keep the runs within this chi2 of the
+                                 best run in the screening.
+           screen_niter (int): Number of iterations in the screening.
+           screen_z_step (int): Redshift step in the screening.
+           band_groups (int): If set, the galaxies are grouped by which bands
+                              are observed and each group is minimized with
+                              only these bands. Patterns with fewer galaxies
+                              than this use all bands. Missing bands are
+                              marked by var_inv <= 1e-100, as set in
+                              galcat_to_arrays.
+           Other arguments as in fit_arrays.
+
+       Returns:
+           List with (chi2, norm, k, n_iter) for each run.
+    """
+
+    config = {'Niter': Niter, 'Nskip': Nskip, 'tol': tol, 'engine': engine,
+              'mem_limit': mem_limit, 'k_method': k_method,
+              'use_numba': use_numba, 'n_threads': n_threads,
+              'prune_floor': prune_floor, 'prune_every': prune_every}
+
+    modelL = [_as_model(f_mod, nb_mask) for f_mod in f_modL]
+
+    if batch_runs:
+        groups = [list(range(len(f_modL)))]
+    else:
+        groups = [[i] for i in range(len(f_modL))]
+
+    startL = None
+    if v0L is not None or k0L is not None:
+        v0L = [None]*len(f_modL) if v0L is None else v0L
+        k0L = [None]*len(f_modL) if k0L is None else k0L
+        startL = [None if v0 is None and k0 is None else (v0, k0)
+                  for v0, k0 in zip(v0L, k0L)]
+
+    if z_step is None:
+        fit = _minimize_grid
+    else:
+        z_width = 2*z_step if z_width is None else z_width
+        fit = partial(_minimize_coarse_fine, z_step=z_step, npeaks=npeaks,
+                      z_width=z_width, warm_start=warm_start)
+
+    def fit_all(modelL, gal, startL):
+        if screen_runs is None or len(modelL) <= screen_runs:
+            return fit(groups, modelL, gal, config, startL=startL)
+
+        keep = _screen_runs(groups, modelL, gal, config, screen_runs,
+                            screen_dchi2, screen_niter, screen_z_step)
+
+        return _minimize_screened(groups, modelL, gal, config, keep, fit, startL)
+
+    if band_groups is None:
+        return fit_all(modelL, _split_galaxies(flux, var_inv, nb_mask), startL)
+
+    observed = 1e-100 < var_inv
+
+    return _fit_band_groups(fit_all, modelL, flux, var_inv, nb_mask, startL,
+                            observed, band_groups)
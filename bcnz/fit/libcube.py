@@ -0,0 +1,114 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Archive of the chi2 and amplitudes for each (run, galaxy, z). The photo-z
+# catalogue can then be estimated again, e.g. with other quality parameters
+# or a subset of the runs, without repeating the minimization.
+
+import os
+from pathlib import Path
+import numpy as np
+import xarray as xr
+
+from . import libpzqual
+
+# The compression and chunking need the netCDF4 library, which the default
+# scipy backend of xarray does not support.
+ENGINE = 'netcdf4'
+
+def check_cube_dir(cube_dir):
+    """Check that the cubes can be written, before running the fit.
+
+       Args:
+           cube_dir (str): Directory for the cubes.
+    """
+
+    try:
+        import netCDF4
+    except ImportError:
+        raise ImportError('Storing the cube requires the netCDF4 package.')
+
+    cube_dir = Path(cube_dir)
+    if not cube_dir.is_dir():
+        raise FileNotFoundError(f'Cube directory does not exist: {cube_dir}')
+
+    if not os.access(cube_dir, os.W_OK):
+        raise PermissionError(f'Cube directory is not writable: {cube_dir}')
+
+def cube_fname(chi2):
+    """File name for the cube of a chunk of galaxies."""
+
+    ref_id = chi2.ref_id.values
+
+    return f'cube_{ref_id.min()}_{ref_id.max()}.nc'
+
+def write_cube(path, chi2, norm, chunk_size=100, complevel=4):
+    """Store the chi2 and norm in a compressed single precision file.
+
+       Args:
+           path (str): Output file.
+           chi2 (DataArray): Chi2 with dimensions (run, ref_id, z).
+           norm (DataArray): Amplitudes with dimensions (run, ref_id, z, model).
+           chunk_size (int): Number of galaxies in each compressed chunk.
+           complevel (int): Compression level.
+    """
+
+    cube = xr.Dataset({'chi2': chi2.transpose('run', 'ref_id', 'z'),
+                       'norm': norm.transpose('run', 'ref_id', 'z', 'model')})
+
+    encoding = {}
+    for key, val in cube.data_vars.items():
+        chunks = list(val.shape)
+        chunks[1] = max(1, min(chunk_size, chunks[1]))
+        encoding[key] = {'dtype': 'float32', 'zlib': True,
+                         'complevel': complevel, 'chunksizes': tuple(chunks)}
+
+    cube.to_netcdf(path, encoding=encoding, engine=ENGINE)
+
+def open_cube(cube_dir):
+    """Open the cubes of all chunks of galaxies.
+
+       Args:
+           cube_dir (str): Directory with the cubes from photoz.
+    """
+
+    paths = sorted(Path(cube_dir).glob('cube_*.nc'))
+    if not paths:
+        raise FileNotFoundError(f'No cubes in: {cube_dir}')
+
+    cube = xr.concat([xr.open_dataset(x, engine=ENGINE) for x in paths],
+                     dim='ref_id')
+
+    return cube
+
+def pzcat_from_cube(cube, odds_lim=0.01, width_frac=0.01, runs=None,
+                    dtype=np.float64):
+    """Estimate the photo-z catalogue from the archived chi2.
+
+       Args:
+           cube (Dataset): Archived chi2 and norm, e.g. from open_cube.
+           odds_lim (float): Limit for estimating the ODDS.
+           width_frac (float): Limit when estimating the pz_width.
+           runs (list): Only combine these runs.
+           dtype (type): Floating point type for estimating the p(z).
+    """
+
+    chi2 = cube.chi2 if runs is None else cube.chi2.sel(run=runs)
+    pzcat, pz = libpzqual.get_pzcat(chi2.load().astype(dtype), odds_lim, width_frac)
+
+    return pzcat, pz
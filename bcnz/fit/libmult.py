@@ -0,0 +1,174 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Compiled version of the multiplicative updates. Each cell is iterated
+# on its own, without allocating temporaries for all the cells in every
+# iteration, and the cells are run in parallel. Numba is optional. When
+# not installed, HAS_NUMBA is False and the Numpy version should be used.
+
+import numpy as np
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+def _jit(func, parallel=True):
+    """Compile the function if Numba is available."""
+
+    if not HAS_NUMBA:
+        return func
+
+    # The Numpy error model gives inf and nan for division by zero,
+    # as in the Numpy version. Only one version of a function can be
+    # cached on disk.
+    return numba.njit(parallel=parallel, cache=parallel, error_model='numpy')(func)
+
+prange = numba.prange if HAS_NUMBA else range
+
+# Largest float, which np.nan_to_num uses for inf.
+_MAX_FLOAT = np.finfo(np.float64).max
+
+def _mult_cells(A_NB, A_BB, b_NB, b_BB, S1, C_NB, Niter, Nskip, tol, use_lsq,
+                ii, jj, v0, k0, i_start):
+    """Multiplicative updates for each cell.
+
+       The matrices are in packed form, with the rows and columns of the
+       entries given by ii and jj. A negative tol means iterating all cells
+       Niter times. The iterations start from v0 and k0, continuing after
+       i_start iterations.
+    """
+
+    ncell, nmodel = b_NB.shape
+    v_out = np.zeros((ncell, nmodel))
+    k_out = np.ones(ncell)
+    n_iter = np.full(ncell, Niter)
+
+    for c in prange(ncell):
+        A = np.empty((nmodel, nmodel))
+        b = np.empty(nmodel)
+        v = np.empty(nmodel)
+        for s in range(nmodel):
+            v[s] = v0[c, s]
+        vn = np.empty(nmodel)
+        v_check = v.copy()
+
+        k = float(k0[c])
+        for s in range(nmodel):
+            b[s] = b_BB[c, s] + k*b_NB[c, s]
+        for p in range(len(ii)):
+            A[ii[p], jj[p]] = A_BB[c, p] + k**2*A_NB[c, p]
+            A[jj[p], ii[p]] = A[ii[p], jj[p]]
+
+        for i in range(Niter):
+            for s in range(nmodel):
+                a = 0.
+                for t in range(nmodel):
+                    a += A[s, t]*v[t]
+
+                # Same as np.nan_to_num.
+                m0 = b[s] / a
+                if np.isnan(m0):
+                    m0 = 0.
+                elif m0 == np.inf:
+                    m0 = _MAX_FLOAT
+                elif m0 == -np.inf:
+                    m0 = -_MAX_FLOAT
+
+                vn[s] = m0*v[s]
+
+            # Extra step for the amplitude
+            if 0 < i + i_start and (i + i_start) % Nskip == 0:
+                # When continuing, the first check has no earlier amplitudes.
+                if 0 <= tol and 0 < i:
+                    done = True
+                    for s in range(nmodel):
+                        rel_change = abs(vn[s] - v_check[s]) / max(abs(v_check[s]), 1e-100)
+                        if rel_change > tol:
+                            done = False
+
+                    if done:
+                        n_iter[c] = i+1
+                        v[:] = vn
+                        break
+
+                if use_lsq:
+                    S1_c = 0.
+                    S2 = 0.
+                    for s in range(nmodel):
+                        S1_c += b_NB[c, s]*vn[s]
+                    for p in range(len(ii)):
+                        weight = 1. if ii[p] == jj[p] else 2.
+                        S2 += weight*vn[ii[p]]*A_NB[c, p]*vn[jj[p]]
+                else:
+                    S1_c = S1[c]
+                    S2 = 0.
+                    for s in range(nmodel):
+                        S2 += C_NB[c, s]*vn[s]
+
+                k = S1_c / S2
+
+                # Just to avoid crazy values ...
+                if k < 0.1:
+                    k = 0.1
+                elif 10 < k:
+                    k = 10.
+
+                for s in range(nmodel):
+                    b[s] = b_BB[c, s] + k*b_NB[c, s]
+                for p in range(len(ii)):
+                    A[ii[p], jj[p]] = A_BB[c, p] + k**2*A_NB[c, p]
+                    A[jj[p], ii[p]] = A[ii[p], jj[p]]
+
+                v_check[:] = vn
+
+            v[:] = vn
+
+        v_out[c] = v
+        k_out[c] = k
+
+    return v_out, k_out, n_iter
+
+# The serial version is used when the caller already runs in several threads,
+# since the default Numba threading layer does not support concurrent calls.
+_mult_cells_parallel = _jit(_mult_cells)
+_mult_cells_serial = _jit(_mult_cells, parallel=False)
+
+def minimize_mult(A_NB, A_BB, b_NB, b_BB, S1, C_NB, Niter, Nskip, tol=None,
+                  k_method='ratio', v0=None, k0=None, i_start=0, parallel=True):
+    """Minimize using the compiled multiplicative updates. Same interface
+       as the Numpy version in bcnz.fit.core, with packed matrices. The start
+       values v0 and k0 are used as given.
+    """
+
+    if k_method not in ('ratio', 'lsq'):
+        raise ValueError(f'Unknown k_method: {k_method}')
+
+    tol = -1. if tol is None else float(tol)
+    # Each cell is internally iterated in double precision.
+    args = [np.ascontiguousarray(x) for x in (A_NB, A_BB, b_NB, b_BB, S1, C_NB)]
+
+    v0 = np.full(b_NB.shape, 100.) if v0 is None else np.ascontiguousarray(v0, dtype=float)
+    k0 = np.ones(len(b_NB)) if k0 is None else np.ascontiguousarray(k0, dtype=float)
+
+    kernel = _mult_cells_parallel if parallel else _mult_cells_serial
+    ii, jj = np.triu_indices(b_NB.shape[1])
+
+    return kernel(*args, int(Niter), int(Nskip), tol, k_method == 'lsq', ii, jj,
+                  v0, k0, int(i_start))
@@ -0,0 +1,127 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Batched non-negative least squares. The active set algorithm of
+# Lawson and Hanson is run for all cells at the same time, working on
+# the normal equations A v = b.
+
+import numpy as np
+
+def _solve_passive(A, b, P):
+    """Solve the linear system only including the passive entries."""
+
+    # The entries not in the passive set get the identity matrix and a zero
+    # right hand side. Their solution is therefore zero.
+    PP = P[:, :, np.newaxis] & P[:, np.newaxis, :]
+    M = np.where(PP, A, 0.)
+    M[:, np.arange(A.shape[1]), np.arange(A.shape[1])] += ~P
+    r = np.where(P, b, 0.)
+
+    try:
+        z = np.linalg.solve(M, r[:, :, np.newaxis])[:, :, 0]
+    except np.linalg.LinAlgError:
+        z = np.einsum('nst,nt->ns', np.linalg.pinv(M), r)
+
+    return np.where(P, z, 0.)
+
+def _warm_start(A, b, P):
+    """Feasible starting point from a guess of the passive set."""
+
+    # Entries becoming negative are removed from the passive set until
+    # the solution is feasible.
+    z = _solve_passive(A, b, P)
+    for i in range(b.shape[1]):
+        neg = P & (z <= 0)
+        is_neg = neg.any(axis=1)
+        if not is_neg.any():
+            break
+
+        P[is_neg] &= ~neg[is_neg]
+        z[is_neg] = _solve_passive(A[is_neg], b[is_neg], P[is_neg])
+
+    # In case the loop above did not finish.
+    P &= (z > 0)
+    z = np.where(P, z, 0.)
+
+    return z, P
+
+def nnls(A, b, P=None, max_iter=None):
+    """Minimize 0.5 v^T A v - b^T v with v >= 0 for each cell.
+
+       Args:
+           A (array): Normal matrices with shape (cell, sed, sed).
+           b (array): Right hand side with shape (cell, sed).
+           P (array): Optional guess of the non-zero entries, for example
+                      from a previous solution.
+           max_iter (int): Maximum number of outer iterations.
+    """
+
+    ncell, nsed = b.shape
+    max_iter = 3*nsed if max_iter is None else max_iter
+
+    if P is None:
+        v = np.zeros_like(b)
+        P = np.zeros((ncell, nsed), dtype=bool)
+    else:
+        v, P = _warm_start(A, b, P.copy())
+
+    tol = 1e-10*np.abs(b).max(axis=1, keepdims=True)
+
+    active = np.arange(ncell)
+    for i in range(max_iter):
+        # Cells without a positive gradient outside of the passive set
+        # have converged.
+        w = b[active] - np.einsum('nst,nt->ns', A[active], v[active])
+        cand = ~P[active] & (w > tol[active])
+        has_cand = cand.any(axis=1)
+
+        active = active[has_cand]
+        if not len(active):
+            break
+
+        w = np.where(cand[has_cand], w[has_cand], -np.inf)
+        P[active, w.argmax(axis=1)] = True
+
+        # Inner loop, removing entries which would become negative.
+        inner = active
+        for j in range(nsed):
+            z = _solve_passive(A[inner], b[inner], P[inner])
+            neg = P[inner] & (z <= 0)
+            is_neg = neg.any(axis=1)
+
+            v[inner[~is_neg]] = z[~is_neg]
+            if not is_neg.any():
+                break
+
+            inner = inner[is_neg]
+            z, neg = z[is_neg], neg[is_neg]
+            v_in = v[inner]
+
+            # Step to the first entry crossing zero.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = np.where(neg, v_in / (v_in - z), np.inf)
+
+            imin = ratio.argmin(axis=1)
+            alpha = ratio[np.arange(len(inner)), imin]
+            v_in = v_in + alpha[:, np.newaxis]*(z - v_in)
+            v_in[np.arange(len(inner)), imin] = 0.
+
+            P[inner] = P[inner] & (v_in > 0)
+            v[inner] = np.where(P[inner], v_in, 0.)
+
+    return v
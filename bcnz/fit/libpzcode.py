@@ -0,0 +1,100 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Compact encoding of the p(z) as one binary entry per galaxy. Only the
+# range of redshifts where the p(z) is above a floor relative to the peak
+# is kept, with the values quantized to 16 bits relative to the peak. Each
+# entry also stores the redshift grid, so it can be decoded on its own.
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+_header = np.dtype([('nz', '<u2'), ('z0', '<f8'), ('dz', '<f8'),
+                    ('i_lo', '<u2'), ('n', '<u2'), ('peak', '<f8')])
+
+_qmax = np.iinfo(np.uint16).max
+
+def encode_pz(pz, rel_floor=1e-6):
+    """Encode the p(z) in a compact binary format.
+
+       Args:
+           pz (DataArray): The p(z) with dimensions (ref_id, z) on a
+                           regular redshift grid.
+           rel_floor (float): Values below this fraction of the peak are
+                              not stored.
+    """
+
+    pz = pz.transpose('ref_id', 'z')
+    z = pz.z.values
+    values = pz.values
+
+    header = np.zeros(1, dtype=_header)
+    header['nz'] = len(z)
+    header['z0'] = z[0]
+    header['dz'] = z[1] - z[0]
+
+    L = []
+    for row in values:
+        peak = row.max()
+        ind = np.nonzero(row >= rel_floor*peak)[0] if 0 < peak else [0]
+        i_lo, i_hi = ind[0], ind[-1]
+
+        header['i_lo'] = i_lo
+        header['n'] = i_hi - i_lo + 1
+        header['peak'] = peak
+
+        scaled = row[i_lo:i_hi+1] / peak if 0 < peak else np.zeros(1)
+        q = np.round(_qmax*scaled).astype('<u2')
+        L.append(header.tobytes() + q.tobytes())
+
+    return pd.Series(L, index=pz.ref_id.values, name='pz', dtype=object)
+
+def decode_pz(codes):
+    """Decode the p(z) from the compact binary format.
+
+       Args:
+           codes (Series): Encoded p(z), indexed by ref_id.
+
+       Returns:
+           The p(z) as a DataArray with dimensions (ref_id, z). Values
+           below the floor are zero. Without any codes, the redshift grid
+           is also empty.
+    """
+
+    # The redshift grid is stored in the codes.
+    if not len(codes):
+        coords = {'ref_id': codes.index.values, 'z': np.zeros(0)}
+        return xr.DataArray(np.zeros((0, 0)), coords=coords, dims=('ref_id', 'z'))
+
+    first = np.frombuffer(codes.iloc[0], dtype=_header, count=1)[0]
+    nz = int(first['nz'])
+    z = first['z0'] + first['dz']*np.arange(nz)
+
+    pz = np.zeros((len(codes), nz))
+    for i, code in enumerate(codes.values):
+        header = np.frombuffer(code, dtype=_header, count=1)[0]
+        i_lo, n = int(header['i_lo']), int(header['n'])
+        q = np.frombuffer(code, dtype='<u2', offset=_header.itemsize, count=n)
+
+        pz[i, i_lo:i_lo+n] = header['peak']*q / _qmax
+
+    coords = {'ref_id': codes.index.values, 'z': z}
+    pz = xr.DataArray(pz, coords=coords, dims=('ref_id', 'z'))
+
+    return pz
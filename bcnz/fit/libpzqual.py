@@ -159,6 +159,60 @@ def get_arrays(data_df, filters):
 
     return flux, flux_err, var_inv
 
+def _cdf_index(cdf, frac, buf):
+    """First index where the CDF exceeds frac, as (cdf > frac).argmax(axis=1).
+       Since the CDF is non-decreasing, this is the number of entries below.
+    """
+
+    np.less_equal(cdf, frac, out=buf)
+    ind = buf.sum(axis=1)
+
+    # Where no entry exceeds frac.
+    return np.where(ind == cdf.shape[1], 0, ind)
+
+def pz_summary(pz, z, odds_lim, width_frac):
+    """The p(z) summary statistics in a single pass, with the CDF
+       only estimated once.
+
+       Args:
+           pz (array): Normalized p(z) with shape (galaxy, z).
+           z (array): Regular redshift grid.
+           odds_lim (float): Parameter in the ODDS calculation.
+           width_frac (float): Parameter in the pz_width calculation.
+    """
+
+    E = np.arange(len(pz))
+    cdf = pz.cumsum(axis=1)
+
+    zbx = z[pz.argmax(axis=1)]
+    zb_mean = (pz*z).sum(axis=1) / pz.sum(axis=1)
+
+    # ODDS, with the CDF linearly interpolated as in odds.
+    z0 = z[0]
+    dz = float(z[1] - z[0])
+    def cdf_at(zx):
+        bins = (np.clip(zx, z[0], z[-1]) - z0) / dz - 1
+        i = np.clip(np.floor(bins), 0, np.infty).astype(int)
+        db = bins - i
+
+        return db*cdf[E, i+1] + (1.-db)*cdf[E, i]
+
+    oddsx = cdf_at(zbx + odds_lim*(1.+zbx)) - cdf_at(zbx - odds_lim*(1.+zbx))
+
+    # The pz_width, as in pz_width.
+    buf = np.empty(cdf.shape, dtype=bool)
+    L = []
+    for frac in [width_frac, 1-width_frac]:
+        ind = _cdf_index(cdf, frac, buf)
+        y_a = cdf[E, ind-1]
+        dy = (cdf[E, ind] - y_a) / (z[ind] - z[ind-1])
+        L.append((z[ind], (frac - y_a) / dy))
+
+    (z1, dz1), (z2, dz2) = L
+    pz_widthx = 0.5*(z2 + dz2 - z1 - dz1)
+
+    return zbx, zb_mean, oddsx, pz_widthx
+
 def get_pzcat(chi2, odds_lim, width_frac):
     """Get photo-z catalogue from the p(z).
        Args:
@@ -167,43 +221,38 @@ def get_pzcat(chi2, odds_lim, width_frac):
            width_frac (float): Parameter in the pz_width calculation.
     """
 
-    pz = np.exp(-0.5*chi2)
+    chi2 = chi2.transpose('run', 'ref_id', 'z')
+    chi2_min = chi2.min(dim=['run', 'z'])
+
+    # In single precision the exponential underflows already for a chi2
+    # around 200. Subtracting the minimum does not change the normalized
+    # p(z).
+    if chi2.dtype == np.float32:
+        pz = np.exp(-0.5*(chi2 - chi2_min))
+    else:
+        pz = np.exp(-0.5*chi2)
+
     pz_norm = pz.sum(dim=['run', 'z'])
     pz_norm = pz_norm.clip(1e-200, np.infty)
 
     pz = pz / pz_norm
     pz = pz.sum(dim='run')
 
-    # Most of this should be moved into the libpzqual
-    # library.
-    zbx = zb(pz).values
-    cat = pd.DataFrame()
-    cat['zb'] = zbx
-    cat['odds'] = odds(pz, zbx, odds_lim)
-    cat['pz_width'] = pz_width(pz, zbx, width_frac)
-    cat['zb_mean'] = zb_bpz2(pz).values
-    cat.index = pz.ref_id.values
-    cat.index.name = 'ref_id'
-
-    cat['chi2'] = chi2.min(dim=['run', 'z']).sel(ref_id=cat.index)
-
-    # These are now in the "libpzqual" file. I could
-    # consider moving them here..
-    pz_widthx = cat.pz_width.values
-    chi2_min = chi2.min(dim=['run', 'z'])
-    cat['qual_par'] = (chi2_min*pz_widthx).values
+    zbx, zb_mean, oddsx, pz_widthx = pz_summary(pz.values, pz.z.values,
+                                                odds_lim, width_frac)
 
-    odds0p2 = odds(pz, cat.zb, odds_lim)
-    cat['qz'] = (chi2_min*pz_widthx / odds0p2.values).values
+    cat = pd.DataFrame(index=pd.Index(pz.ref_id.values, name='ref_id'))
+    cat['zb'] = zbx
+    cat['odds'] = oddsx
+    cat['pz_width'] = pz_widthx
+    cat['zb_mean'] = zb_mean
+    cat['chi2'] = chi2_min.values
+    cat['qual_par'] = chi2_min.values*pz_widthx
+    cat['qz'] = chi2_min.values*pz_widthx / oddsx
 
     # The run which contribute most to the redshift peak ...
-    iz = pz.argmin(dim='z')
-
-    points = chi2.isel(z=iz)
-#    ipdb.set_trace()
-#    points = chi2.isel_points(ref_id=range(len(chi2.ref_id)), z=iz)
-
-    # Since old xarray versions does not support idxmin...
-    cat['best_run'] = points.run[points.argmin(dim='run')]
+    iz = pz.values.argmin(axis=1)
+    points = chi2.values[:, np.arange(len(iz)), iz]
+    cat['best_run'] = chi2.run.values[points.argmin(axis=0)]
 
     return cat, pz
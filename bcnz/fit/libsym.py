@@ -0,0 +1,92 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Symmetric matrices stored in packed form. Only the upper triangle is kept,
+# with the last axis running over the entries given by np.triu_indices.
+
+from functools import lru_cache
+import numpy as np
+
+@lru_cache(maxsize=None)
+def sym_index(nmodel):
+    """Row and column of the packed entries."""
+
+    return np.triu_indices(nmodel)
+
+@lru_cache(maxsize=None)
+def _row_index(nmodel):
+    """Position of each matrix entry in the packed array."""
+
+    ii, jj = sym_index(nmodel)
+    index = np.empty((nmodel, nmodel), dtype=int)
+    index[ii, jj] = np.arange(len(ii))
+    index[jj, ii] = np.arange(len(ii))
+
+    return index
+
+def npacked(nmodel):
+    """Number of packed entries."""
+
+    return nmodel*(nmodel + 1) // 2
+
+def nmodel_from_packed(npack):
+    """Size of the matrix from the number of packed entries."""
+
+    return int(round((np.sqrt(8*npack + 1) - 1) / 2))
+
+def pack(A):
+    """Packed form of symmetric matrices with shape (..., sed, sed)."""
+
+    ii, jj = sym_index(A.shape[-1])
+
+    return A[..., ii, jj]
+
+def unpack(Ap):
+    """Full matrices from the packed form."""
+
+    nmodel = nmodel_from_packed(Ap.shape[-1])
+    index = _row_index(nmodel)
+
+    # A single gather is faster than assigning both triangles.
+    A = np.take(Ap, index.ravel(), axis=-1)
+
+    return A.reshape(Ap.shape[:-1] + (nmodel, nmodel))
+
+def outer(f):
+    """Packed outer product of the last axis with itself."""
+
+    ii, jj = sym_index(f.shape[-1])
+
+    return f[..., ii]*f[..., jj]
+
+def matvec(Ap, v):
+    """The product A v for each cell, with shapes (cell, packed) and (cell, sed)."""
+
+    # Looping over the rows keeps the temporaries at the size of v.
+    index = _row_index(v.shape[1])
+
+    a = np.empty_like(v)
+    for s in range(v.shape[1]):
+        a[:, s] = np.einsum('cp,cp->c', Ap[:, index[s]], v)
+
+    return a
+
+def quad(Ap, v):
+    """The quadratic form v^T A v for each cell."""
+
+    return (matvec(Ap, v)*v).sum(axis=1)
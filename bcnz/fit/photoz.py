@@ -17,6 +17,7 @@
 # encoding: UTF8
 
 import time
+from pathlib import Path
 import dask
 import dask.distributed
 import numpy as np
@@ -24,13 +25,16 @@ import pandas as pd
 import xarray as xr
 from IPython.core import debugger as ipdb
 
+from . import core
 from . import libpzqual
+from . import libcube
+from . import libpzcode
 
 
 #np.seterr(over='raise')
 
 
-def galcat_to_arrays(data_df, bands, scale_input=False):
+def galcat_to_arrays(data_df, bands, scale_input=False, dtype=np.float64):
     """Convert the galcat dataframe to arrays."""
 
     # Seperating this book keeping also makes it simpler to write
@@ -71,123 +75,164 @@ def galcat_to_arrays(data_df, bands, scale_input=False):
     var_inv.values = np.where(to_use, var_inv, 1e-100)
     flux_error.values = np.where(to_use, flux_error, 1e-100)
 
+    # Missing values underflow to zero in single precision.
+    flux, flux_error, var_inv = [x.astype(dtype) for x in (flux, flux_error, var_inv)]
 
     return flux, flux_error, var_inv
 
 
-def _core_allz(ref_id, f_mod, flux, var_inv, Niter, Nskip):
-    """Minimize the chi2 expression."""
+def _normalize_model(f_mod, dtype=np.float64):
+    """Normalize the model, keeping the xarray coordinates."""
 
-    # Normalizing the models to avoid too large numbers.
-    f_mod = f_mod / f_mod.max(dim=('band', 'z'))
+    f_mod = f_mod.transpose('z', 'band', 'model')
+    f_mod = f_mod.copy(data=core.normalize_model(f_mod.values.astype(dtype)))
 
-    # To avoid very low numbers which would result in a large amplitude...
-    f_mod = f_mod.where(f_mod > 1e-3, 0)
+    return f_mod
 
+def _to_xarray(ref_id, entry, chi2, v, k, n_iter):
+    """Store the minimization results as DataArrays."""
 
-    NBlist = list(filter(lambda x: x.startswith('pau_nb'), flux.band.values))
-    BBlist = list(filter(lambda x: not x.startswith('pau_nb'), flux.band.values))
+    ref_id = np.array(ref_id)
+    coords_chi2 = {'ref_id': ref_id, 'z': entry['z']}
+    coords_norm = {'ref_id': ref_id, 'z': entry['z'], 'model': entry['model']}
 
-    A_NB = np.einsum('gf,zfs,zft->gzst', var_inv.sel(band=NBlist), \
-           f_mod.sel(band=NBlist), f_mod.sel(band=NBlist))
-    b_NB = np.einsum('gf,gf,zfs->gzs', var_inv.sel(band=NBlist), flux.sel(band=NBlist), \
-           f_mod.sel(band=NBlist))
-    A_BB = np.einsum('gf,zfs,zft->gzst', var_inv.sel(band=BBlist), \
-           f_mod.sel(band=BBlist), f_mod.sel(band=BBlist))
-    b_BB = np.einsum('gf,gf,zfs->gzs', var_inv.sel(band=BBlist), flux.sel(band=BBlist), \
-           f_mod.sel(band=BBlist))
+    chi2x = xr.DataArray(chi2, coords=coords_chi2, dims=('ref_id', 'z'))
+    norm = xr.DataArray(v, coords=coords_norm, dims=\
+                        ('ref_id','z','model'))
+    k = xr.DataArray(k, coords=coords_chi2, dims=('ref_id', 'z'))
+    n_iter = xr.DataArray(n_iter, coords=coords_chi2, dims=('ref_id', 'z'))
 
-    # Testing to scale to the narrow bands. In that case the code above is not needed.
-    scale_to = NBlist
-    var_inv_NB = var_inv.sel(band=scale_to)
-    flux_NB = flux.sel(band=scale_to)
-    f_mod_NB = f_mod.sel(band=scale_to)
-    S1 = (var_inv_NB*flux_NB).sum(dim='band')
+    return chi2x, norm, k, n_iter
 
-    # Since we need these entries in the beginning...
-    k = np.ones((len(flux), len(f_mod.z)))
-    b = b_BB + k[:,:,np.newaxis]*b_NB
-    A = A_BB + k[:,:,np.newaxis,np.newaxis]**2*A_NB
+def _start_from_norm(norm0, keys, ref_id, cacheL, k0=None):
+    """Start amplitudes and NB versus BB scaling for each run from a
+       previous fit. Galaxies, runs and redshifts not in norm0 use the
+       default start.
+    """
 
-    v = 100*np.ones_like(b)
+    v0L, k0L = [], []
+    for key, entry in zip(keys, cacheL):
+        if int(key) not in norm0.run:
+            v0L.append(None)
+            k0L.append(None)
+            continue
 
-    ref_id = np.array(ref_id)
-    coords = {'ref_id': ref_id, 'band': f_mod.band, 'z': f_mod.z}
-    coords_norm = {'ref_id': ref_id, 'z': f_mod.z, 'model': f_mod.model}
+        index = {'ref_id': np.array(ref_id), 'z': entry['z']}
+        part = norm0.sel(run=int(key)).reindex(model=entry['model'], **index)
+        v0L.append(part.transpose('ref_id', 'z', 'model').values)
 
-    t1 = time.time()
-    for i in range(Niter):
-        a = np.einsum('gzst,gzt->gzs', A, v)
+        if k0 is not None and int(key) in k0.run:
+            part = k0.sel(run=int(key)).reindex(**index)
+            k0L.append(part.transpose('ref_id', 'z').values)
+        else:
+            k0L.append(None)
 
-        m0 = b / a
-        m0 = np.nan_to_num(m0)
+    return v0L, k0L
 
-        vn = m0*v
-        v = vn
-            
-        # Extra step for the amplitude
-        if 0 < i and i % Nskip == 0:
-            # Testing a new form for scaling the amplitude...
-            S2 = np.einsum('gf,zfs,gzs->gz', var_inv_NB, f_mod_NB, v)
-            k = (S1.values/S2.T).T
+def _nb_mask(bands):
+    """Which of the bands are narrow bands."""
 
-            # Just to avoid crazy values ...
-            k = np.clip(k, 0.1, 10)
+    return np.array([x.startswith('pau_nb') for x in bands])
 
-            b = b_BB + k[:,:,np.newaxis]*b_NB
-            A = A_BB + k[:,:,np.newaxis,np.newaxis]**2*A_NB
+def prepare_models(modelD, fit_bands, dtype=np.float64):
+    """Normalize the models and precompute the model products.
 
-    
-    # I was comparing with the standard algorithm above...
-    v_scaled = v
-    k_scaled = k
-
-    L = []
-    L.append(np.einsum('gz,zfs,gzs->gzf', k_scaled, f_mod.sel(band=NBlist), v_scaled))
-    L.append(np.einsum('zfs,gzs->gzf', f_mod.sel(band=BBlist), v_scaled))
+       The result only depends on the models and can be computed once,
+       e.g. scattered to the Dask workers, and then passed to photoz as
+       model_cache.
 
-    Fx = np.dstack(L)
-    coords['band'] = NBlist + BBlist
-    Fx = xr.DataArray(Fx, coords=coords, dims=('ref_id', 'z', 'band'))
+       Args:
+           modelD (dict): Dictionary containing all the flux models.
+           fit_bands (list): List of bands to fit.
+           dtype (type): Floating point type of the models.
+    """
 
-    # Now with another scaling...
-    chi2x = var_inv*(flux - Fx)**2
-    Fx = xr.DataArray(Fx, coords=coords, dims=('ref_id', 'z', 'band'))
-    chi2x = var_inv*(flux - Fx)**2
-    chi2x = chi2x.sum(dim='band')
+    cacheD = {}
+    for key, f_mod in modelD.items():
+        # Supporting both interfaces.
+        if isinstance(f_mod, dask.distributed.client.Future):
+            f_mod = f_mod.result()
 
-    norm = xr.DataArray(v_scaled, coords=coords_norm, dims=\
-                        ('ref_id','z','model'))
+        f_mod = _normalize_model(f_mod, dtype).sel(band=fit_bands)
+        cacheD[key] = {'z': f_mod.z.values, 'model': f_mod.model.values,
+                       'band': list(fit_bands),
+                       'core': core.prepare_model(f_mod.values, _nb_mask(fit_bands))}
 
-    return chi2x, norm
+    return cacheD
 
 def minimize_all_z(data_df, modelD, **config): #fit_bands, Niter, Nskip):
-    """Combines the chi2 estimate for all models into a single structure."""
+    """Combines the chi2 estimate for all models into a single structure.
 
-    flux, _, var_inv = galcat_to_arrays(data_df, config['fit_bands'])
-    ref_id = data_df.index
+       The minimization itself is done in bcnz.fit.core, working on the
+       underlying arrays.
+    """
 
-    L = []
-    args = (config['Niter'], config['Nskip'])
+    dtype = config.get('dtype', np.float64)
+    flux, _, var_inv = galcat_to_arrays(data_df, config['fit_bands'], dtype=dtype)
+    ref_id = data_df.index
     keys = list(modelD.keys())
-    for key in keys:
-        # Supporting both interfaces.
-        f_mod = modelD[key]
-        if isinstance(f_mod, dask.distributed.client.Future):
-            f_mod = f_mod.result()
 
-        if isinstance(f_mod, str):
-            1 / 0
+    model_cache = config.get('model_cache')
+    if model_cache is None:
+        model_cache = prepare_models(modelD, list(flux.band.values), dtype)
 
-        L.append(_core_allz(ref_id, f_mod, flux, var_inv, *args))
+    cacheL = []
+    for key in keys:
+        # Supporting both interfaces.
+        entry = model_cache[key]
+        if isinstance(entry, dask.distributed.client.Future):
+            entry = entry.result()
+
+        assert entry['band'] == list(flux.band.values), 'Different bands in model_cache'
+        cacheL.append(entry)
+
+    nb_mask = _nb_mask(flux.band.values)
+
+    # The coarse grid and windows are given in redshift steps.
+    z = cacheL[0]['z']
+    dz = float(z[1] - z[0])
+    dz_coarse = config.get('dz_coarse')
+    z_step, z_width = None, None
+    if dz_coarse is not None:
+        z_step = max(1, int(round(dz_coarse / dz)))
+        dz_window = config.get('dz_window')
+        z_width = int(round((2*dz_coarse if dz_window is None else dz_window) / dz))
+
+    screen_z_step = max(1, int(round(config.get('screen_dz', 0.05) / dz)))
+
+    norm0 = config.get('norm0')
+    v0L, k0L = (None, None) if norm0 is None else \
+               _start_from_norm(norm0, keys, ref_id, cacheL, config.get('k0'))
+
+    R = core.fit_runs(flux.values, var_inv.values, [x['core'] for x in cacheL],
+                      nb_mask, Niter=config['Niter'], Nskip=config['Nskip'],
+                      tol=config.get('tol'), engine=config.get('engine', 'mult'),
+                      mem_limit=config.get('mem_limit'),
+                      use_numba=config.get('use_numba', True),
+                      batch_runs=config.get('batch_runs', False),
+                      z_step=z_step, npeaks=config.get('npeaks', 3),
+                      z_width=z_width, n_threads=config.get('n_threads'),
+                      v0L=v0L, k0L=k0L, warm_start=config.get('warm_start', False),
+                      screen_runs=config.get('screen_runs'),
+                      screen_dchi2=config.get('screen_dchi2'),
+                      screen_niter=config.get('screen_niter', 50),
+                      screen_z_step=screen_z_step,
+                      prune_floor=config.get('prune_floor'),
+                      prune_every=config.get('prune_every', 100),
+                      band_groups=config.get('band_groups'))
+
+    L = [_to_xarray(ref_id, entry, chi2, v, k, n_iter) for entry, (chi2, v, k, n_iter)
+         in zip(cacheL, R)]
 
     dim = pd.Index([int(x) for x in keys], name='run')
-    chi2L, normL = zip(*L)
+    chi2L, normL, kL, n_iterL = zip(*L)
 
     chi2 = xr.concat(chi2L, dim=dim)
     norm = xr.concat(normL, dim=dim)
+    k = xr.concat(kL, dim=dim)
+    n_iter = xr.concat(n_iterL, dim=dim)
 
-    return chi2, norm
+    return chi2, norm, n_iter, k
 
 
 def flatten_models(modelD):
@@ -275,7 +320,12 @@ def _find_iband(fit_bands):
     raise ValueError('No i-band is included in the parameters.')
 
 def photoz(galcat, modelD, ebvD, fit_bands, Niter=1000, Nskip=10, odds_lim=0.01,
-           width_frac=0.01, i_band='', only_pz=True):
+           width_frac=0.01, i_band='', only_pz=True, mem_limit=None, tol=None,
+           engine='mult', dz_coarse=None, npeaks=3, dz_window=None,
+           batch_runs=False, use_numba=True, model_cache=None, n_threads=None,
+           dtype=np.float64, norm0=None, k0=None, warm_start=False, screen_runs=None,
+           screen_dchi2=None, screen_niter=50, screen_dz=0.05, prune_floor=None,
+           prune_every=100, band_groups=None, cube_dir=None):
     """Estimates the photoz for the models for a given configuration.
 
        Args:
@@ -290,17 +340,95 @@ def photoz(galcat, modelD, ebvD, fit_bands, Niter=1000, Nskip=10, odds_lim=0.01,
            i_band (str): The i-band for which to return the model.
            only_pz (bool): Only return the photo-z catalogue. Otherwise return
                           pzcat, best_model, model_z0, iband_model, pz
+           mem_limit (float): Memory budget (MB) for the minimization. The
+                              galaxies and redshifts are split into blocks.
+           tol (float): Stop iterating a (galaxy, z) cell when the relative
+                        change in the amplitudes is below this tolerance.
+                        The mean number of iterations is then added as
+                        the n_iter column.
+           engine (str): Minimization algorithm. Either 'mult' for the
+                         multiplicative updates or 'nnls' for an exact
+                         non-negative least squares solver.
+           dz_coarse (float): If set, first fit on a redshift grid with this
+                              spacing and then refine around the peaks.
+           npeaks (int): Number of p(z) peaks to refine for each galaxy.
+           dz_window (float): Half width of the refined windows. Defaults
+                              to 2*dz_coarse.
+           batch_runs (bool): Minimize all runs together in a single padded
+                              model array.
+           use_numba (bool): Use the compiled kernel for the multiplicative
+                             updates when Numba is installed.
+           model_cache (dict): Precomputed models from prepare_models.
+           n_threads (int): Number of threads for fitting the runs in
+                            parallel. The BLAS then runs single threaded.
+           dtype (type): Floating point type used in the fit and the p(z),
+                         e.g. np.float32. The model_cache should be prepared
+                         with the same type.
+           norm0 (DataArray): Amplitudes from a previous minimize_all_z, used
+                              as starting point. Only reduces the iterations
+                              when setting tol.
+           k0 (DataArray): NB versus BB scaling from the same minimize_all_z
+                           as norm0. The cells are then restored as given,
+                           instead of recomputing the scaling.
+           warm_start (bool): Start the refined redshifts from the coarse grid
+                              amplitudes when using dz_coarse.
+           screen_runs (int): Only fully minimize this number of runs for
+                              each galaxy, selected by a cheap minimization.
+                              The other runs get chi2=inf. Validate the
+                              setting with compare_screening.
+           screen_dchi2 (float): Also fully minimize the runs within this
+                                 chi2 of the best run in the screening.
+           screen_niter (int): Number of iterations in the screening.
+           screen_dz (float): Redshift spacing in the screening.
+           prune_floor (float): Stop iterating the (galaxy, z) cells which
+                                can not reach this fraction of the p(z) peak
+                                of the galaxy, e.g. 1e-10.
+           prune_every (int): Iterations between checking the cells to prune.
+           band_groups (int): Minimize the galaxies grouped by which bands
+                              are observed, using only these bands. Only the
+                              patterns with at least this many galaxies are
+                              grouped.
+           cube_dir (str): If set, store the chi2 and norm in this directory,
+                           for estimating the photo-z catalogue again with
+                           libcube.pzcat_from_cube.
     """
 
-    config = {'fit_bands': fit_bands, 'Niter': Niter, 'Nskip': Nskip}
+    config = {'fit_bands': fit_bands, 'Niter': Niter, 'Nskip': Nskip,
+              'mem_limit': mem_limit, 'tol': tol, 'engine': engine,
+              'dz_coarse': dz_coarse, 'npeaks': npeaks, 'dz_window': dz_window,
+              'batch_runs': batch_runs, 'use_numba': use_numba,
+              'model_cache': model_cache, 'n_threads': n_threads,
+              'dtype': dtype, 'norm0': norm0, 'k0': k0,
+              'warm_start': warm_start,
+              'screen_runs': screen_runs, 'screen_dchi2': screen_dchi2,
+              'screen_niter': screen_niter, 'screen_dz': screen_dz,
+              'prune_floor': prune_floor, 'prune_every': prune_every,
+              'band_groups': band_groups}
 
     # Propagating this value is a bit tedious when one can infer it
     # from the provided bands..
     i_band = i_band if i_band else _find_iband(fit_bands)
 
-    chi2, norm = minimize_all_z(galcat, modelD, **config)
+    # Otherwise a missing backend is only found after the fit.
+    if cube_dir is not None:
+        libcube.check_cube_dir(cube_dir)
+
+    chi2, norm, n_iter, _ = minimize_all_z(galcat, modelD, **config)
+
+    # The cubes are named by the galaxies, so empty partitions are skipped.
+    if cube_dir is not None and len(chi2.ref_id):
+        libcube.write_cube(Path(cube_dir) / libcube.cube_fname(chi2), chi2, norm)
+
     pzcat, pz = libpzqual.get_pzcat(chi2, odds_lim, width_frac)
 
+    # Report on how much of the iterations were actually needed, which
+    # only varies with early stopping in the multiplicative updates.
+    if tol is not None and engine == 'mult':
+        if n_iter.size:
+            print('Iterations: {} of {} ({:.1%})'.format(
+                  int(n_iter.sum()), Niter*n_iter.size, float(n_iter.sum()) / (Niter*n_iter.size)))
+        pzcat['n_iter'] = n_iter.mean(dim=['run', 'z']).sel(ref_id=pzcat.index).values
+
     model = flatten_models(modelD)
 
     # Set the number of bands. 
@@ -335,12 +463,15 @@ def flatten_input(df):
 
     return comb
 
-def photoz_flatten(galcat, *args, **kwds):
+def photoz_flatten(galcat, *args, pz_format='columns', **kwds):
     """When working with parallel processing frameworks which works simpler
        having a flat hirarchy both in the input and output.
        
        Args:
            galcat (df): Galaxy catalogue in a hirarchical format.
+           pz_format (str): Store the p(z) as one column per redshift
+                            ('columns') or encoded in a single binary
+                            column ('binary'), decoded with decode_pz.
     """
 
     #galcat = _flatten_input(galcat)
@@ -348,8 +479,13 @@ def photoz_flatten(galcat, *args, **kwds):
 
     # Combine into a flat data structure. For example Dask does not support a
     # hirarchical data structure.
-    pz = pd.DataFrame(pz.values, columns = [f'z{x}' for x in range(pz.shape[1])])
-    pz.index = pzcat.index
+    if pz_format == 'columns':
+        pz = pd.DataFrame(pz.values, columns = [f'z{x}' for x in range(pz.shape[1])])
+        pz.index = pzcat.index
+    elif pz_format == 'binary':
+        pz = libpzcode.encode_pz(pz).loc[pzcat.index]
+    else:
+        raise ValueError(f'Unknown pz_format: {pz_format}')
 
     df_out = pd.concat([pzcat, best_model, model_z0, iband_model, pz], axis=1)
     
@@ -0,0 +1,112 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Content addressed caching of the expensive stages. The file name of each
+# stored product includes a fingerprint of the input data and parameters,
+# so changing any of them gives a new file instead of silently reusing a
+# stale result. Files on disk are fingerprinted by their name, size and
+# modification time, not by reading them.
+
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+def _update(h, obj):
+    """Add an object to the hash."""
+
+    h.update(type(obj).__name__.encode())
+
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        names = obj.columns if isinstance(obj, pd.DataFrame) else [obj.name]
+        h.update(repr(list(names)).encode())
+        h.update(repr(list(obj.index.names)).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif isinstance(obj, xr.DataArray):
+        _update(h, obj.dims)
+        _update(h, {k: v.values for k, v in obj.coords.items()})
+        _update(h, obj.values)
+    elif isinstance(obj, np.ndarray):
+        h.update(f'{obj.dtype.str}{obj.shape}'.encode())
+        if obj.dtype.hasobject:
+            h.update(repr(obj.tolist()).encode())
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=repr):
+            _update(h, key)
+            _update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(str(len(obj)).encode())
+        for x in obj:
+            _update(h, x)
+    elif isinstance(obj, Path):
+        path = obj.expanduser()
+        files = sorted(path.rglob('*')) if path.is_dir() else [path]
+        for x in files:
+            if not x.is_file():
+                continue
+            stat = x.stat()
+            h.update(f'{x.relative_to(path.parent)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    else:
+        h.update(repr(obj).encode())
+
+def fingerprint(*args, **kwds):
+    """Short hash of the input data and parameters.
+
+       Args:
+           args: Data frames, arrays, paths or simple Python objects.
+           kwds: Parameters, which are included with their names.
+    """
+
+    h = hashlib.sha256()
+    _update(h, args)
+    _update(h, kwds)
+
+    return h.hexdigest()[:16]
+
+def keyed_path(path, key):
+    """Path with the key added to the file name."""
+
+    path = Path(path)
+
+    return path.with_name(f'{path.stem}_{key}{path.suffix}')
+
+def cached(path, compute, load, save):
+    """Load the stored result or compute and store it.
+
+       Args:
+           path (str): Location of the stored result, e.g. from keyed_path.
+           compute (function): Computes the result without arguments.
+           load (function): Reads the result from a path.
+           save (function): Writes the result to a path.
+    """
+
+    path = Path(path)
+    if path.exists():
+        return load(path)
+
+    result = compute()
+
+    # Writing to a temporary file avoids leaving a partial result.
+    path_tmp = path.with_name(path.name + '.tmp')
+    save(result, path_tmp)
+    path_tmp.replace(path)
+
+    return result
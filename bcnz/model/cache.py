@@ -18,13 +18,26 @@ from IPython.core import debugger as ipdb
 from pathlib import Path
 import xarray as xr
 
-def model_fname(sed, ext_law, EBV):
+from ..libcache import fingerprint
+
+def model_fname(sed, ext_law, EBV, key=None):
     """File name when caching the model."""
     
     fname = '{}:{}:{:.3f}.nc'.format(sed, ext_law, EBV)
+    if key is not None:
+        fname = fname.replace('.nc', f':{key}.nc')
     
     return fname
 
+def model_key(row):
+    """Fingerprint of the model parameters not in the file name."""
+
+    conf = row.drop(['seds', 'ext_law', 'EBV']).to_dict()
+    if 'sed_dir' in conf:
+        conf['sed_dir'] = Path(conf['sed_dir'])
+
+    return fingerprint(**conf)
+
 def cache_model(model_dir, runs):
     """Load models if already run, otherwise run one.
        Args:
@@ -44,7 +57,7 @@ def cache_model(model_dir, runs):
     model_dir = Path(model_dir)
     for i, (_, row) in enumerate(runs_flat.iterrows()):
         sed = row.seds[0]
-        fname = model_fname(sed, row.ext_law, row.EBV)
+        fname = model_fname(sed, row.ext_law, row.EBV, model_key(row))
         path = model_dir / fname
      
         if path.exists():
@@ -59,8 +72,9 @@ def cache_model(model_dir, runs):
     D = {}
     for i, row in runs.iterrows():
         L = []
+        key = model_key(row)
         for j, sed in enumerate(row.seds):
-            fname = model_fname(sed, row.ext_law, row.EBV)
+            fname = model_fname(sed, row.ext_law, row.EBV, key)
             path = model_dir / fname
 
             # The line of creating a new array is very important. Without
@@ -36,6 +36,7 @@ setup(
         'fire',
         'numpy',
         'matplotlib',
+        'netCDF4',
         'pandas',
         'pyarrow',
         'scipy',
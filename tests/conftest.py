@@ -0,0 +1,100 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+# Small synthetic models and galaxies for the regression tests. The models
+# are smooth bumps moving with redshift, so the galaxies have a clear best
+# redshift without needing the SED and filter files.
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+NB = [f'pau_nb{x}' for x in 455+10*np.arange(40)]
+BB = ['cfht_u', 'subaru_b', 'subaru_v', 'subaru_r', 'subaru_i', 'subaru_z']
+FIT_BANDS = NB + BB
+
+def make_models(nz=30, nseds=(4, 4, 6), seed=1):
+    """Models for each run with dimensions (z, band, model)."""
+
+    rng = np.random.default_rng(seed)
+    z = np.round(np.linspace(0.01, 1.5, nz), 4)
+    x = np.linspace(0, 1, len(FIT_BANDS))
+
+    modelD = {}
+    for i, ns in enumerate(nseds):
+        center = rng.uniform(0, 1, (1, 1, ns)) + 0.3*z[:, None, None]
+        f_mod = np.exp(-(x[None, :, None] - center)**2 / 0.1)
+        f_mod = f_mod*rng.uniform(0.5, 2., (1, 1, ns)) + 1e-4
+
+        coords = {'z': z, 'band': FIT_BANDS,
+                  'model': [f'sed{i}_{j}' for j in range(ns)]}
+        modelD[i] = xr.DataArray(f_mod, dims=('z', 'band', 'model'), coords=coords)
+
+    return modelD
+
+def make_galcat(modelD, ngal=12, seed=2):
+    """Galaxies in the flattened input format, with the true redshift."""
+
+    rng = np.random.default_rng(seed)
+
+    L, zs = [], []
+    for g in range(ngal):
+        f_mod = modelD[list(modelD)[rng.integers(len(modelD))]]
+        iz = rng.integers(len(f_mod.z))
+        L.append(f_mod.isel(z=iz).values @ rng.uniform(0.2, 1, len(f_mod.model)))
+        zs.append(float(f_mod.z[iz]))
+
+    flux = np.array(L)
+    err = 0.03*flux.mean(axis=1, keepdims=True) + 0.03*flux
+    flux = flux + err*rng.normal(size=flux.shape)
+
+    index = pd.Index(np.arange(1000, 1000+ngal), name='ref_id')
+    galcat = pd.concat(
+        [pd.DataFrame(flux, index=index, columns=[f'flux_{x}' for x in FIT_BANDS]),
+         pd.DataFrame(err, index=index, columns=[f'flux_error_{x}' for x in FIT_BANDS])],
+        axis=1)
+    galcat['zs'] = zs
+
+    return galcat
+
+@pytest.fixture(scope='session')
+def fit_bands():
+    return FIT_BANDS
+
+@pytest.fixture(scope='session')
+def modelD():
+    return make_models()
+
+@pytest.fixture(scope='session')
+def galcat(modelD):
+    return make_galcat(modelD)
+
+@pytest.fixture(scope='session')
+def arrays(modelD, galcat):
+    """Fluxes, inverse variances, normalized model and the NB mask."""
+
+    from bcnz.fit import core
+
+    flux = galcat[[f'flux_{x}' for x in FIT_BANDS]].values
+    err = galcat[[f'flux_error_{x}' for x in FIT_BANDS]].values
+    var_inv = 1. / err**2
+    f_mod = core.normalize_model(modelD[0].values)
+    nb_mask = np.array([x in NB for x in FIT_BANDS])
+
+    return flux, var_inv, f_mod, nb_mask
@@ -0,0 +1,198 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import importlib
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+
+from bcnz.calib import cache, libcalib
+
+from conftest import make_models
+
+calib_mod = importlib.import_module('bcnz.calib.calib')
+
+@pytest.fixture(scope='module')
+def calib_input(fit_bands):
+    """Calibration galaxies with known zero-point offsets."""
+
+    modelD = make_models(nseds=(6, 6, 10))
+    modelD = {k: v.rename(model='sed') for k, v in modelD.items()}
+
+    rng = np.random.default_rng(3)
+    L, zs = [], []
+    for g in range(40):
+        f_mod = modelD[list(modelD)[rng.integers(len(modelD))]]
+        iz = rng.integers(len(f_mod.z))
+        L.append(f_mod.isel(z=iz).values @ rng.uniform(0, 1, len(f_mod.sed)))
+        zs.append(float(f_mod.z[iz]))
+
+    flux = np.array(L)*(1 + 0.05*rng.normal(size=len(fit_bands)))
+    err = 0.03*flux.mean(axis=1, keepdims=True) + 0.03*flux
+    flux = flux + err*rng.normal(size=flux.shape)
+
+    index = pd.Index(np.arange(len(zs)), name='ref_id')
+    galcat = pd.concat({'flux': pd.DataFrame(flux, index=index, columns=fit_bands),
+                        'flux_error': pd.DataFrame(err, index=index, columns=fit_bands)},
+                       axis=1)
+    galcat['zs'] = zs
+
+    return galcat, modelD
+
+CONFIG = {'Nrounds': 3, 'Niter': 200, 'zp_method': 'bisect'}
+
+def test_bootstrap(calib_input, fit_bands):
+    """The bootstrap samples should start from the same point as the fit
+       of all galaxies, so a sample with each galaxy once is identical.
+    """
+
+    galcat, modelD = calib_input
+    zp, zp_boot = calib_mod.calib(galcat, modelD, fit_bands, n_boot=2,
+                                  boot_seed=1, **CONFIG)
+
+    assert zp_boot.shape == (len(fit_bands), 2)
+    assert np.isfinite(zp_boot.values).all()
+
+    sub = calib_mod.sel_subset(galcat, fit_bands)
+    f_modD = libcalib.model_at_z(sub.zs, modelD, fit_bands)
+    config = dict(fit_bands=fit_bands, SNR_min=-5, cosmos_scale=False,
+                  learn_rate=1.0, Nskip=10, tol=None, warm_start=False,
+                  zp_tol=None, n_procs=None, client=None, **CONFIG)
+
+    zp_all = calib_mod._zp_replicate((f_modD, sub, config), np.arange(len(sub)))
+    np.testing.assert_allclose(zp_all.values, zp.values, rtol=1e-10)
+
+def _as_arrays(*arrays):
+    dims = ('ref_id', 'band')
+    coords = {'ref_id': np.arange(len(arrays[0])),
+              'band': [f'b{i}' for i in range(arrays[0].shape[1])]}
+
+    return [xr.DataArray(x, dims=dims, coords=coords) for x in arrays]
+
+def test_bisect_not_above_minimize():
+    """The bisection should reach at least the median cost of the separate
+       minimization in each band.
+    """
+
+    rng = np.random.default_rng(4)
+    best_flux = rng.uniform(1, 2, (51, 5))
+    flux = best_flux / (1 + 0.05*rng.normal(size=5)) + 0.05*rng.normal(size=(51, 5))
+    X = _as_arrays(best_flux, flux, np.full((51, 5), 0.05))
+
+    def cost(zp):
+        res = (X[1]*zp - X[0]) / X[2]
+        return np.abs(res.median(dim='ref_id')).values
+
+    zp_min = calib_mod._calc_zp(*X, zp_method='minimize')
+    zp_bisect = calib_mod._calc_zp(*X, zp_method='bisect')
+
+    # The gradient based minimization can stop early on the piecewise
+    # linear median, while the bisection finds the crossing.
+    assert (cost(zp_bisect) <= cost(zp_min) + 1e-6).all()
+    assert (cost(zp_bisect) < 1e-6).all()
+
+def test_zp_tol_same_as_fewer_rounds(calib_input, fit_bands):
+    """Stopping on converged zero-points should give the result of only
+       running those rounds.
+    """
+
+    galcat, modelD = calib_input
+    config = dict(CONFIG, learn_rate=0.01, return_details=True)
+
+    zp, zp_details, _ = calib_mod.calib(galcat, modelD, fit_bands, zp_tol=2e-3,
+                                        **dict(config, Nrounds=10))
+
+    nrounds = zp_details.shape[1]
+    assert nrounds < 10
+
+    zp_ref, _, _ = calib_mod.calib(galcat, modelD, fit_bands,
+                                   **dict(config, Nrounds=nrounds))
+    np.testing.assert_array_equal(zp.values, zp_ref.values)
+
+def test_warm_start_not_worse(calib_input, fit_bands):
+    """Continuing the minimization between the rounds should not give a
+       worse fit than restarting it.
+    """
+
+    galcat, modelD = calib_input
+
+    def final_chi2(warm_start):
+        zp, _, ratio_all = calib_mod.calib(galcat, modelD, fit_bands,
+                                           return_details=True,
+                                           warm_start=warm_start, **CONFIG)
+
+        ratio = ratio_all.ratio.unstack('band')[fit_bands]
+        flux = galcat.flux[fit_bands].loc[ratio.index]
+        flux_error = galcat.flux_error[fit_bands].loc[ratio.index]
+
+        return float((((flux*zp - ratio*flux) / (flux_error*zp))**2).sum().sum())
+
+    assert final_chi2(True) <= final_chi2(False)
+
+def test_process_pool_same_as_serial(calib_input, fit_bands):
+    """Fitting the model parts in separate processes should not change
+       the zero-points.
+    """
+
+    galcat, modelD = calib_input
+    config = dict(CONFIG, Nrounds=1)
+
+    zp = calib_mod.calib(galcat, modelD, fit_bands, **config)
+    zp_procs = calib_mod.calib(galcat, modelD, fit_bands, n_procs=2, **config)
+
+    np.testing.assert_array_equal(zp_procs.values, zp.values)
+
+def test_cache_zp(tmp_path, calib_input, fit_bands, monkeypatch):
+    """The zero-points should be stored once and options returning more
+       than the zero-points rejected.
+    """
+
+    galcat, modelD = calib_input
+    for name, val in [('return_details', True), ('n_boot', 2)]:
+        with pytest.raises(ValueError):
+            cache.cache_zp(tmp_path, galcat, modelD, fit_bands, **{name: val}, **CONFIG)
+
+    zp = cache.cache_zp(tmp_path, galcat, modelD, fit_bands, Nrounds=1, Niter=100,
+                        zp_method='bisect')
+    assert len(list(tmp_path.glob('zp_*.h5'))) == 1
+
+    def fail(*args, **kwds):
+        raise AssertionError('The zero-points should be loaded.')
+
+    monkeypatch.setattr(cache, 'calib', fail)
+    zp_cached = cache.cache_zp(tmp_path, galcat, modelD, fit_bands, Nrounds=1,
+                               Niter=100, zp_method='bisect')
+    pd.testing.assert_series_equal(zp_cached, zp)
+
+def test_bisect_without_crossing():
+    """Bands without a crossing in the bisection range should use the
+       separate minimization.
+    """
+
+    # The second band has no measurements. In the third, the negative flux
+    # makes the median residual |R - 1|, which has no sign change.
+    best_flux = np.array([[1., 1., 1.], [2., 1., -1.], [3., 1., -5.]])
+    flux = np.array([[1., np.nan, 1.], [2., np.nan, -1.], [3., np.nan, 0.]])
+    X = _as_arrays(best_flux, 1.1*flux, np.ones_like(flux))
+
+    zp = calib_mod._calc_zp(*X, zp_method='bisect')
+    zp_min = calib_mod._calc_zp(*X, zp_method='minimize')
+
+    np.testing.assert_allclose(zp, [1 / 1.1, 1., 1 / 1.1], rtol=1e-6)
+    np.testing.assert_allclose(zp[1:], zp_min[1:])
@@ -0,0 +1,33 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import numpy as np
+
+from bcnz.fit import compare
+
+def test_reference_row(galcat, modelD, fit_bands):
+    """The reference configuration should have no differences to itself."""
+
+    comp = compare.compare_screening(galcat, modelD, fit_bands, screen_runs=(1,),
+                                     Niter=100)
+
+    assert comp.index.name == 'screen_runs' and list(comp.index) == ['all', 1]
+    assert comp.columns[0] == 'time'
+    assert comp.loc['all', 'frac_same_zb'] == 1
+    assert comp.loc['all', 'dchi2_min_max'] == 0
+    assert np.isfinite(comp.values).all()
@@ -0,0 +1,156 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import numpy as np
+import pytest
+
+from bcnz.fit import core
+
+def test_nnls_not_above_mult(arrays):
+    """The exact NNLS solution should never have a higher chi2."""
+
+    chi2_mult = core.fit_arrays(*arrays, k_method='lsq')[0]
+    chi2_nnls = core.fit_arrays(*arrays, engine='nnls')[0]
+
+    assert (chi2_nnls <= chi2_mult + 1e-6*np.abs(chi2_mult)).all()
+
+def test_screening_without_kept_galaxies(arrays, modelD):
+    """Runs not kept for any galaxy should get chi2=inf."""
+
+    flux, var_inv, f_mod, nb_mask = arrays
+    f_modL = [core.normalize_model(x.values) for x in modelD.values()]
+
+    # With two galaxies, at least one of the three runs is not kept.
+    chi2L = [x[0] for x in core.fit_runs(flux[:2], var_inv[:2], f_modL, nb_mask,
+                                         screen_runs=1, mem_limit=1)]
+
+    n_kept = [np.isfinite(x).any(axis=1) for x in chi2L]
+    assert (np.sum(n_kept, axis=0) == 1).all()
+    assert any(np.isinf(x).all() for x in chi2L)
+
+def test_restart_from_own_solution(arrays):
+    """Cells restarted from their own converged solution should stop at
+       the first check.
+    """
+
+    Nskip = 10
+    chi2, v, k, n_iter = core.fit_arrays(*arrays, Niter=3000, Nskip=Nskip, tol=1e-2)
+    conv = n_iter < 3000
+    assert conv.any()
+
+    chi2_warm, _, _, n_warm = core.fit_arrays(*arrays, Niter=3000, Nskip=Nskip,
+                                              tol=1e-2, v0=v, k0=k)
+
+    assert np.median(n_warm[conv]) == Nskip
+    assert n_warm[conv].mean() < 0.2*n_iter[conv].mean()
+
+def test_pruning_keeps_contributing_cells(arrays):
+    """Pruning should not change the cells iterated to the end and only
+       remove cells far below the p(z) peak.
+    """
+
+    floor = 1e-10
+    chi2, _, _, _ = core.fit_arrays(*arrays, Niter=1000)
+    chi2_prune, _, _, n_iter = core.fit_arrays(*arrays, Niter=1000,
+                                               prune_floor=floor)
+
+    kept = n_iter == 1000
+    assert kept.any() and not kept.all()
+    np.testing.assert_array_equal(chi2_prune[kept], chi2[kept])
+
+    dchi2 = chi2 - chi2.min(axis=1, keepdims=True)
+    assert (dchi2[~kept] > -2*np.log(floor)).all()
+
+def test_blocks_same_as_single_pass(arrays):
+    """Splitting into memory-bounded blocks should not change the result."""
+
+    chi2, v, _, _ = core.fit_arrays(*arrays, Niter=500)
+    chi2_blocks, v_blocks, _, _ = core.fit_arrays(*arrays, Niter=500, mem_limit=0.05)
+
+    np.testing.assert_array_equal(chi2_blocks, chi2)
+    np.testing.assert_array_equal(v_blocks, v)
+
+def test_numba_same_as_numpy(arrays):
+    """The compiled kernel should follow the NumPy updates."""
+
+    pytest.importorskip('numba')
+
+    chi2, _, _, _ = core.fit_arrays(*arrays, Niter=500, use_numba=False)
+    chi2_numba, _, _, _ = core.fit_arrays(*arrays, Niter=500, use_numba=True)
+
+    np.testing.assert_allclose(chi2_numba, chi2, rtol=1e-10)
+
+def _fit_runs(flux, var_inv, modelD, nb_mask, **kwds):
+    f_modL = [core.normalize_model(x.values) for x in modelD.values()]
+
+    return [x[0] for x in core.fit_runs(flux, var_inv, f_modL, nb_mask,
+                                        Niter=500, **kwds)]
+
+def test_batch_runs_same_as_separate(arrays, modelD):
+    """Minimizing the runs in one padded array should not change the chi2."""
+
+    flux, var_inv, _, nb_mask = arrays
+    chi2L = _fit_runs(flux, var_inv, modelD, nb_mask)
+    chi2L_batch = _fit_runs(flux, var_inv, modelD, nb_mask, batch_runs=True)
+
+    for chi2, chi2_batch in zip(chi2L, chi2L_batch):
+        np.testing.assert_allclose(chi2_batch, chi2, rtol=1e-10)
+
+@pytest.mark.parametrize('use_numba', [True, False])
+def test_threads_same_as_serial(arrays, modelD, use_numba):
+    """Fitting the runs on a thread pool should not change the chi2."""
+
+    flux, var_inv, _, nb_mask = arrays
+    chi2L = _fit_runs(flux, var_inv, modelD, nb_mask, use_numba=use_numba)
+    chi2L_threads = _fit_runs(flux, var_inv, modelD, nb_mask, use_numba=use_numba,
+                              n_threads=2)
+
+    for chi2, chi2_threads in zip(chi2L, chi2L_threads):
+        np.testing.assert_allclose(chi2_threads, chi2, rtol=1e-12)
+
+def test_band_groups_with_missing_bands(arrays, modelD):
+    """Fitting the galaxies with only their observed bands should match
+       fitting all bands with zero weight in the missing ones.
+    """
+
+    flux, var_inv, _, nb_mask = arrays
+    flux, var_inv = flux.copy(), var_inv.copy()
+
+    missing = [3, 7, 11, 41]
+    flux[:6, missing] = 0
+    var_inv[:6, missing] = 0
+
+    chi2L = _fit_runs(flux, var_inv, modelD, nb_mask)
+    chi2L_groups = _fit_runs(flux, var_inv, modelD, nb_mask, band_groups=1)
+
+    for chi2, chi2_groups in zip(chi2L, chi2L_groups):
+        np.testing.assert_allclose(chi2_groups, chi2, rtol=1e-8)
+
+def test_start_values_floor():
+    """Only restored cells keep vanishing start amplitudes, since the
+       multiplicative updates can not grow them again.
+    """
+
+    v0 = np.array([[1., 1e-30, 0.], [1., 1e-30, 0.]])
+    restored = np.array([False, True])
+    v, k = core._start_values(v0, np.array([np.nan, 2.]), v0.shape, np.float64,
+                              restored)
+
+    np.testing.assert_array_equal(v[0], [1., 1e-3, 1e-3])
+    np.testing.assert_array_equal(v[1], v0[1])
+    np.testing.assert_array_equal(k, [1., 2.])
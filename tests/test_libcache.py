@@ -0,0 +1,50 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import pandas as pd
+
+from bcnz import libcache
+
+def test_fingerprint(galcat):
+    """The key should only depend on the content."""
+
+    key = libcache.fingerprint(galcat, Niter=100)
+
+    assert key == libcache.fingerprint(galcat.copy(), Niter=100)
+    assert key != libcache.fingerprint(galcat, Niter=101)
+
+    galcat_mod = galcat.copy()
+    galcat_mod.iloc[0, 0] *= 1.01
+    assert key != libcache.fingerprint(galcat_mod, Niter=100)
+
+def test_cached(tmp_path):
+    """The second call should load the stored result."""
+
+    calls = []
+    def compute():
+        calls.append(1)
+        return pd.Series([1., 2.], name='x')
+
+    path = libcache.keyed_path(tmp_path / 'x.pq', 'abc')
+    args = (lambda x: pd.read_pickle(x), lambda S, x: S.to_pickle(x))
+
+    S1 = libcache.cached(path, compute, *args)
+    S2 = libcache.cached(path, compute, *args)
+
+    assert path.name == 'x_abc.pq' and len(calls) == 1
+    pd.testing.assert_series_equal(S1, S2)
@@ -0,0 +1,71 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import importlib
+import sys
+import numpy as np
+import pytest
+
+from bcnz.fit import libcube
+
+photoz_mod = importlib.import_module('bcnz.fit.photoz')
+
+EBVD = {0: 0., 1: 0., 2: 0.1}
+
+def test_missing_backend_fails_before_fit(monkeypatch, tmp_path, galcat, modelD,
+                                          fit_bands):
+    """Without netCDF4, storing the cube should fail before fitting."""
+
+    def fail(*args, **kwds):
+        raise AssertionError('The fit should not start.')
+
+    monkeypatch.setitem(sys.modules, 'netCDF4', None)
+    monkeypatch.setattr(photoz_mod, 'minimize_all_z', fail)
+
+    with pytest.raises(ImportError):
+        photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, cube_dir=tmp_path)
+
+def test_missing_cube_dir(tmp_path):
+    pytest.importorskip('netCDF4')
+
+    with pytest.raises(FileNotFoundError):
+        libcube.check_cube_dir(tmp_path / 'missing')
+
+def test_cube_round_trip(tmp_path, galcat, modelD, fit_bands):
+    """The catalogue from the cube should match the one from the fit."""
+
+    pytest.importorskip('netCDF4')
+
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=200,
+                              cube_dir=tmp_path)
+    pzcat_cube, _ = libcube.pzcat_from_cube(libcube.open_cube(tmp_path))
+
+    # The cube is stored in single precision.
+    zb = pzcat_cube.zb.loc[pzcat.index]
+    assert np.abs(zb - pzcat.zb).max() < 1e-3
+
+def test_empty_partition(tmp_path, galcat, modelD, fit_bands):
+    """An empty partition should not write a cube."""
+
+    pytest.importorskip('netCDF4')
+
+    pzcat = photoz_mod.photoz(galcat.iloc[:0], modelD, EBVD, fit_bands,
+                              Niter=100, cube_dir=tmp_path)
+
+    assert len(pzcat) == 0
+    assert not list(tmp_path.glob('cube_*.nc'))
@@ -0,0 +1,74 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import numpy as np
+import xarray as xr
+import pytest
+
+from bcnz.fit import libpzcode, libpzqual
+
+@pytest.fixture(scope='module')
+def pz():
+    """Normalized p(z) with one or two peaks."""
+
+    rng = np.random.default_rng(5)
+    z = np.round(0.01 + 0.01*np.arange(150), 4)
+
+    center = rng.uniform(0.1, 1.4, (20, 2))
+    width = rng.uniform(0.02, 0.1, (20, 2))
+    amp = np.array([1., 0.3])*rng.uniform(0, 1, (20, 2))
+    pz = (amp[:, None]*np.exp(-0.5*((z[None, :, None] - center[:, None]) / width[:, None])**2)).sum(axis=2)
+    pz /= pz.sum(axis=1, keepdims=True)
+
+    return xr.DataArray(pz, dims=('ref_id', 'z'),
+                        coords={'ref_id': np.arange(20), 'z': z})
+
+def test_pz_summary(pz):
+    """The single pass should match the separate estimators."""
+
+    odds_lim, width_frac = 0.01, 0.01
+    zbx, zb_mean, oddsx, pz_widthx = libpzqual.pz_summary(
+        pz.values, pz.z.values, odds_lim, width_frac)
+
+    zb_ref = libpzqual.zb(pz)
+    np.testing.assert_array_equal(zbx, zb_ref.values)
+    np.testing.assert_allclose(zb_mean, libpzqual.zb_bpz2(pz).values)
+    np.testing.assert_allclose(oddsx, libpzqual.odds(pz, zb_ref, odds_lim).values)
+    np.testing.assert_allclose(pz_widthx, libpzqual.pz_width(pz, zb_ref, width_frac))
+
+def test_encode_round_trip(pz):
+    """The decoded p(z) should only differ by the quantization and floor."""
+
+    rel_floor = 1e-6
+    pz_dec = libpzcode.decode_pz(libpzcode.encode_pz(pz, rel_floor))
+
+    np.testing.assert_allclose(pz_dec.z, pz.z)
+    np.testing.assert_array_equal(pz_dec.ref_id, pz.ref_id)
+
+    peak = pz.max(dim='z')
+    assert (np.abs(pz_dec - pz) <= peak*max(rel_floor, 1. / 65535)).all()
+    assert (pz_dec.argmax(dim='z') == pz.argmax(dim='z')).all()
+
+def test_encode_empty(pz):
+    """The p(z) of an empty partition should round trip."""
+
+    codes = libpzcode.encode_pz(pz.isel(ref_id=slice(0, 0)))
+    pz_dec = libpzcode.decode_pz(codes)
+
+    assert len(codes) == 0 and codes.dtype == object
+    assert pz_dec.dims == ('ref_id', 'z') and pz_dec.shape == (0, 0)
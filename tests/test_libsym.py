@@ -0,0 +1,47 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import numpy as np
+
+from bcnz.fit import core, libsym
+
+def test_against_dense():
+    """The packed operations should match the dense matrices."""
+
+    rng = np.random.default_rng(6)
+    f = rng.uniform(size=(8, 20, 5))
+    v = rng.uniform(size=(20, 5))
+
+    A = np.einsum('fcs,fct->cst', f, f)
+    Ap = libsym.pack(A)
+
+    assert Ap.shape == (20, libsym.npacked(5))
+    assert libsym.nmodel_from_packed(Ap.shape[-1]) == 5
+
+    np.testing.assert_array_equal(libsym.unpack(Ap), A)
+    np.testing.assert_allclose(libsym.outer(f).sum(axis=0), Ap)
+    np.testing.assert_allclose(libsym.matvec(Ap, v), np.einsum('cst,ct->cs', A, v))
+    np.testing.assert_allclose(libsym.quad(Ap, v), np.einsum('cs,cst,ct->c', v, A, v))
+
+def test_dtype_and_block_size():
+    """The packed matrices keep the dtype, which sets the block size."""
+
+    Ap = np.ones((3, libsym.npacked(4)), dtype=np.float32)
+    assert libsym.unpack(Ap).dtype == np.float32
+
+    assert core._cell_bytes(46, 10, 4) == core._cell_bytes(46, 10, 8) // 2
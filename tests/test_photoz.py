@@ -0,0 +1,158 @@
+# Copyright (C) 2020 Martin B. Eriksen
+# This file is part of BCNz <https://github.com/PAU-survey/bcnz>.
+#
+# BCNz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# BCNz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with BCNz.  If not, see <http://www.gnu.org/licenses/>.
+#!/usr/bin/env python
+# encoding: UTF8
+
+import importlib
+import numpy as np
+import pytest
+
+photoz_mod = importlib.import_module('bcnz.fit.photoz')
+
+EBVD = {0: 0., 1: 0., 2: 0.1}
+
+def test_n_iter_only_with_tol(galcat, modelD, fit_bands):
+    """The n_iter column should only be added with early stopping."""
+
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=100)
+    assert 'n_iter' not in pzcat.columns
+
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=100,
+                              engine='nnls', tol=1e-4)
+    assert 'n_iter' not in pzcat.columns
+
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=100, tol=1e-4)
+    assert (pzcat.n_iter <= 100).all()
+
+def test_coarse_to_fine(galcat, modelD, fit_bands):
+    """Refining around the peaks should find the same best fit."""
+
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=500)
+    pzcat_fine = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=500,
+                                   dz_coarse=0.1)
+
+    # The redshifts outside the windows only change the tails of the p(z).
+    assert (pzcat_fine.zb == pzcat.zb).all()
+    np.testing.assert_allclose(pzcat_fine.chi2, pzcat.chi2, rtol=1e-10)
+    np.testing.assert_allclose(pzcat_fine.odds, pzcat.odds, atol=0.01)
+
+def test_float32(galcat, modelD, fit_bands):
+    """Fitting in single precision should only give small differences."""
+
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=500)
+    pzcat32 = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=500,
+                                dtype=np.float32)
+
+    assert (pzcat32.zb == pzcat.zb).all()
+    np.testing.assert_allclose(pzcat32.chi2, pzcat.chi2, rtol=1e-3)
+    np.testing.assert_allclose(pzcat32.odds, pzcat.odds, atol=1e-3)
+
+def test_coarse_to_fine_warm_start(galcat, modelD, fit_bands):
+    """Starting the refined redshifts from the coarse grid should reach
+       the same fit as starting them from scratch.
+    """
+
+    config = {'Niter': 3000, 'dz_coarse': 0.1}
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, **config)
+    pzcat_warm = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands,
+                                   warm_start=True, **config)
+
+    # The multiplicative updates are not fully converged, so a galaxy with
+    # a broad p(z) can end one redshift step away.
+    dz = float(modelD[0].z[1] - modelD[0].z[0])
+    assert (pzcat_warm.zb == pzcat.zb).mean() > 0.8
+    assert (np.abs(pzcat_warm.zb - pzcat.zb) <= dz + 1e-6).all()
+    np.testing.assert_allclose(pzcat_warm.chi2, pzcat.chi2, rtol=1e-2)
+
+@pytest.mark.parametrize('config', [{}, {'screen_runs': 1}, {'band_groups': 1},
+                                    {'tol': 1e-3}])
+def test_empty_input(galcat, modelD, fit_bands, config):
+    """An empty partition should give an empty catalogue."""
+
+    pzcat = photoz_mod.photoz(galcat.iloc[:0], modelD, EBVD, fit_bands,
+                              Niter=100, **config)
+    pzcat_ref = photoz_mod.photoz(galcat.iloc[:1], modelD, EBVD, fit_bands,
+                                  Niter=100, **config)
+
+    assert len(pzcat) == 0
+    assert list(pzcat.columns) == list(pzcat_ref.columns)
+
+def _baseline_core_allz(f_mod, flux, var_inv, Niter, Nskip):
+    """The original multiplicative updates on the dense matrices."""
+
+    f_mod = f_mod / f_mod.max(dim=('band', 'z'))
+    f_mod = f_mod.where(f_mod > 1e-3, 0).sel(band=flux.band).values
+
+    nb = np.array([x.startswith('pau_nb') for x in flux.band.values])
+    flux, var_inv = flux.values, var_inv.values
+
+    def terms(mask):
+        A = np.einsum('gf,zfs,zft->gzst', var_inv[:,mask], f_mod[:,mask], f_mod[:,mask])
+        b = np.einsum('gf,gf,zfs->gzs', var_inv[:,mask], flux[:,mask], f_mod[:,mask])
+        return A, b
+
+    A_NB, b_NB = terms(nb)
+    A_BB, b_BB = terms(~nb)
+    S1 = (var_inv[:,nb]*flux[:,nb]).sum(axis=1)
+
+    k = np.ones(b_NB.shape[:2])
+    b = b_BB + k[:,:,None]*b_NB
+    A = A_BB + k[:,:,None,None]**2*A_NB
+    v = 100*np.ones_like(b)
+    for i in range(Niter):
+        v = np.nan_to_num(b / np.einsum('gzst,gzt->gzs', A, v))*v
+
+        if 0 < i and i % Nskip == 0:
+            S2 = np.einsum('gf,zfs,gzs->gz', var_inv[:,nb], f_mod[:,nb], v)
+            k = np.clip(S1[:,None] / S2, 0.1, 10)
+            b = b_BB + k[:,:,None]*b_NB
+            A = A_BB + k[:,:,None,None]**2*A_NB
+
+    F = np.concatenate([np.einsum('gz,zfs,gzs->gzf', k, f_mod[:,nb], v),
+                        np.einsum('zfs,gzs->gzf', f_mod[:,~nb], v)], axis=2)
+    chi2 = (np.hstack([var_inv[:,nb], var_inv[:,~nb]])[:,None] * \
+            (np.hstack([flux[:,nb], flux[:,~nb]])[:,None] - F)**2).sum(axis=2)
+
+    return chi2, v
+
+def test_default_same_as_baseline(galcat, modelD, fit_bands):
+    """The default minimization should reproduce the original algorithm."""
+
+    Niter, Nskip = 300, 10
+    chi2, norm, _, _ = photoz_mod.minimize_all_z(galcat, modelD, fit_bands=fit_bands,
+                                                 Niter=Niter, Nskip=Nskip)
+
+    flux, _, var_inv = photoz_mod.galcat_to_arrays(galcat, fit_bands)
+    for run, f_mod in modelD.items():
+        chi2_ref, v_ref = _baseline_core_allz(f_mod, flux, var_inv, Niter, Nskip)
+
+        part = chi2.sel(run=run).transpose('ref_id', 'z').values
+        np.testing.assert_allclose(part, chi2_ref, rtol=1e-8)
+
+        v = norm.sel(run=run).dropna('model', how='all').transpose('ref_id', 'z', 'model')
+        np.testing.assert_allclose(v.values, v_ref, rtol=1e-6, atol=1e-10)
+
+def test_model_cache(galcat, modelD, fit_bands):
+    """Passing the prepared models should not change the photo-z."""
+
+    model_cache = photoz_mod.prepare_models(modelD, fit_bands)
+    pzcat = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=200)
+    pzcat_cache = photoz_mod.photoz(galcat, modelD, EBVD, fit_bands, Niter=200,
+                                    model_cache=model_cache)
+
+    assert (pzcat_cache.zb == pzcat.zb).all()
+    np.testing.assert_array_equal(pzcat_cache.chi2, pzcat.chi2)
+    np.testing.assert_array_equal(pzcat_cache.odds, pzcat.odds)